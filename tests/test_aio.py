@@ -0,0 +1,200 @@
+import asyncio
+import json
+
+import pytest
+
+aiohttp = pytest.importorskip("aiohttp")
+from aiohttp import web
+
+from workflow4ds.hue import aio
+from workflow4ds.hue.aio import AsyncNotebook
+
+LOGIN_REQUIRED = "/* login required */"
+
+
+class FakeHue(object):
+    """
+    minimal Hue server: a single query whose result is range(n_rows) in one int column,
+    served through a server-side cursor like fetch_result_data
+    """
+
+    def __init__(self, n_rows=10000):
+        self.n_rows = n_rows
+        self.cursor = 0
+        self.n_logins = 0
+        self.n_fetches = 0
+        self.fetched_rows = []
+        # number of the fetch request to fail and how: "timeout" or "proxy"
+        self.fail_fetch = None
+        self.fail_mode = None
+        # respond "login required" to the next n requests
+        self.n_expired = 0
+        self.expire_create_notebook = False
+
+    def app(self):
+        app = web.Application()
+        app.router.add_get("/accounts/login/", self.login_page)
+        app.router.add_post("/accounts/login/", self.login)
+        app.router.add_post("/notebook/api/create_notebook", self.create_notebook)
+        app.router.add_post("/notebook/api/create_session", self.create_session)
+        app.router.add_post("/notebook/api/execute/hive", self.execute)
+        app.router.add_post("/notebook/api/get_logs", self.get_logs)
+        app.router.add_post("/notebook/api/check_status", self.check_status)
+        app.router.add_post("/notebook/api/fetch_result_data/", self.fetch_result_data)
+        app.router.add_post("/notebook/api/close_statement", self.ok)
+        app.router.add_post("/notebook/api/notebook/close/", self.ok)
+        return app
+
+    def _expired(self):
+        if self.n_expired > 0:
+            self.n_expired -= 1
+            return True
+        return False
+
+    async def login_page(self, request):
+        res = web.Response(text="<html></html>")
+        res.set_cookie("csrftoken", "token")
+        return res
+
+    async def login(self, request):
+        data = await request.post()
+        if data["password"] != "secret":
+            return web.Response(text='<div class="errorList"></div>')
+        self.n_logins += 1
+        return web.Response(status=302, headers={"Location": "/"})
+
+    async def create_notebook(self, request):
+        if self.expire_create_notebook:
+            return web.Response(text=LOGIN_REQUIRED)
+        return web.json_response({"status": 0, "notebook": {
+            "uuid": "nb", "isSaved": False, "sessions": [], "type": "hive"}})
+
+    async def create_session(self, request):
+        return web.json_response({"status": 0, "session": {"id": 1, "type": "hive"}})
+
+    async def execute(self, request):
+        if self._expired():
+            return web.Response(text=LOGIN_REQUIRED)
+        return web.json_response({"status": 0, "handle": {"statement_id": 0},
+                                  "history_id": 1, "history_uuid": "history"})
+
+    async def get_logs(self, request):
+        return web.json_response({"status": 0, "logs": "INFO  : OK", "jobs": [], "progress": 1.})
+
+    async def check_status(self, request):
+        if self._expired():
+            return web.Response(text=LOGIN_REQUIRED)
+        return web.json_response({"status": 0, "query_status": {"status": "available"}})
+
+    async def fetch_result_data(self, request):
+        data = await request.post()
+        rows = int(data["rows"])
+        if data["startOver"] == "true":
+            self.cursor = 0
+
+        self.n_fetches += 1
+        start, self.cursor = self.cursor, min(self.n_rows, self.cursor + rows)
+        if self.n_fetches == self.fail_fetch:
+            # cursor has moved forward although the page never arrives
+            if self.fail_mode == "timeout":
+                await asyncio.sleep(1.)
+            return web.Response(status=502, text="<h1>Proxy Error</h1>")
+
+        self.fetched_rows.append(rows)
+        return web.json_response({"status": 0, "result": {
+            "data": [[str(i)] for i in range(start, self.cursor)],
+            "meta": [{"name": "t.id", "type": "INT_TYPE"}],
+            "has_more": self.cursor < self.n_rows}})
+
+    async def ok(self, request):
+        return web.json_response({"status": 0})
+
+
+def run(hue, coroutine_function):
+    """
+    serve hue on a local port and run coroutine_function(notebook) against it
+    """
+    async def main():
+        runner = web.AppRunner(hue.app())
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        try:
+            async with AsyncNotebook("user", "secret", base_url=f"http://127.0.0.1:{port}") as nb:
+                return await asyncio.wait_for(coroutine_function(nb), timeout=10)
+        finally:
+            await runner.cleanup()
+
+    return asyncio.run(main())
+
+
+async def fetch_ids(nb, rows_per_fetch=4096):
+    result = await nb.execute("select id from t", sync=False)
+    await result.await_result(wait_sec=0)
+    result.rows_per_fetch = rows_per_fetch
+    result.adaptive_fetch = False
+    df = await result.to_frame()
+    return df["id"].tolist()
+
+
+def test_execute_and_fetch():
+    hue = FakeHue()
+    assert run(hue, fetch_ids) == list(range(hue.n_rows))
+    assert hue.n_logins == 1
+
+
+@pytest.mark.parametrize("fail_mode", ["proxy", "timeout"])
+def test_fetch_shrinks_and_restarts(monkeypatch, fail_mode):
+    monkeypatch.setattr(aio, "HUE_FETCH_TIMEOUT_SECS", .2)
+    hue = FakeHue()
+    hue.fail_fetch, hue.fail_mode = 2, fail_mode
+
+    assert run(hue, fetch_ids) == list(range(hue.n_rows))
+    # first page is fetched again after restart, with fewer rows per request
+    assert hue.fetched_rows[0] == 4096
+    assert all(rows < 4096 for rows in hue.fetched_rows[1:])
+
+
+def test_relogin_once_on_concurrent_login_required():
+    hue = FakeHue()
+
+    async def check_concurrently(nb):
+        result = await nb.execute("select id from t", sync=False)
+        hue.n_expired = 4
+        await asyncio.gather(*(result.check_status(update_interval=0) for _ in range(4)))
+        return result.status
+
+    assert run(hue, check_concurrently) == "available"
+    assert hue.n_logins == 2
+
+
+def test_login_required_during_login_does_not_deadlock():
+    hue = FakeHue()
+
+    async def relogin(nb):
+        hue.n_expired = 1
+        hue.expire_create_notebook = True
+        with pytest.raises(RuntimeError, match="login required"):
+            await nb.execute("select 1")
+
+    run(hue, relogin)
+
+
+def test_login_failed():
+    hue = FakeHue()
+
+    async def main():
+        runner = web.AppRunner(hue.app())
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        try:
+            with pytest.raises(ValueError, match="login failed"):
+                async with AsyncNotebook("user", "wrong", base_url=f"http://127.0.0.1:{port}"):
+                    pass
+        finally:
+            await runner.cleanup()
+
+    asyncio.run(main())
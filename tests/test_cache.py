@@ -0,0 +1,76 @@
+import json
+import logging
+import threading
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip("pyarrow")
+
+from workflow4ds.hue.cache import ResultCache, CachedResult
+from workflow4ds.hue.hue import NotebookResult
+
+META = [{"name": "t.id", "type": "INT_TYPE"},
+        {"name": "t.amount", "type": "DOUBLE_TYPE"},
+        {"name": "t.ratio", "type": "FLOAT_TYPE"},
+        {"name": "t.price", "type": "DECIMAL_TYPE"},
+        {"name": "t.flag", "type": "BOOLEAN_TYPE"},
+        {"name": "t.dt", "type": "DATE_TYPE"},
+        {"name": "t.ts", "type": "TIMESTAMP_TYPE"},
+        {"name": "t.name", "type": "STRING_TYPE"}]
+
+# cells as Hue returns them: numbers as json numbers, the others as strings
+PAGES = [
+    [[1, 0.1, 0.1, "12.50", "true", "2024-01-01", "2024-01-01 00:00:00", "a"],
+     [2, 1e20, 3.4028235e38, "-0.01", "false", "1999-12-31", "2024-01-01 08:30:15.25", "b&amp;c"]],
+    [["NULL", "NULL", "NULL", "NULL", "NULL", "NULL", "NULL", "NULL"],
+     [-2147483648, 2.5, 1.5, "100.00", "true", "2024-02-29", "2024-02-29 23:59:59.123456", "ｄ"]],
+]
+
+
+class FakeResponse(object):
+    def __init__(self, obj):
+        self.text = json.dumps(obj)
+        self.content = self.text.encode("utf-8")
+        self.status_code = 200
+
+    def json(self):
+        return json.loads(self.text)
+
+
+def make_result(pages):
+    result = NotebookResult.__new__(NotebookResult)
+    result.log = logging.getLogger(__name__)
+    result.name = "test"
+    result.status = "available"
+    result.handle = SimpleNamespace(statement="select * from t")
+    result.rows_per_fetch = 2
+    result.adaptive_fetch = False
+    result.prefetch_pages = 0
+    result._cache = None
+    result._consumed = False
+    result._close_when_consumed = False
+    result._close_lock = threading.Lock()
+
+    it = iter(pages)
+
+    def fetch_result(rows=None, start_over=False):
+        data = next(it)
+        return FakeResponse({"status": 0, "result": {"data": data, "meta": META,
+                                                     "has_more": data is not pages[-1]}})
+
+    result._fetch_result = fetch_result
+    return result
+
+
+def test_cached_fetchall_equals_uncached(tmp_path):
+    expected = make_result(PAGES).fetchall(progressbar=False)
+
+    cache = ResultCache(str(tmp_path))
+    result = make_result(PAGES)
+    result._cache = (cache, "key")
+    result.to_frame(progressbar=False)
+
+    cached = CachedResult(cache.get("key")).fetchall(progressbar=False)
+    assert cached["columns"] == expected["columns"]
+    assert cached["data"] == expected["data"]
@@ -31,7 +31,16 @@ def ensure_login(func):
     return wrapper
 
 
-def retry(module='', attempts: int = 3, wait_sec: int = 3):
+def retry(module='', attempts: int = 3, wait_sec: int = 3, raise_on: tuple = ()):
+    """
+    retry decorated function on exception or error response
+
+    :param module: logger name prefix
+    :param attempts: maximum number of attempts
+    :param wait_sec: seconds to wait between attempts
+    :param raise_on: exception types raised at once instead of retried,
+                     for callers that handle them on their own
+    """
     def retry_wrapper(func):
         @wraps(func)
         def wrapper(self, *args, **kwargs):
@@ -50,6 +59,10 @@ def retry(module='', attempts: int = 3, wait_sec: int = 3):
                 except (KeyboardInterrupt, AssertionError, RuntimeError) as e:
                     raise e
 
+                except raise_on as e:
+                    logger.warning(f"{type(e).__name__} in {i}/{attempts} attempts, not retried")
+                    raise e
+
                 except Exception as e:
                     logger.warning(f"exception thrown in {i}/{attempts} attempts:")
                     logger.warning(e)
@@ -1,6 +1,8 @@
 """
 @Author: Allen Li    supermrli@hotmail.com
 """
+import itertools
+import math
 import os
 import time
 from typing import Union
@@ -9,12 +11,18 @@ import getpass
 import importlib.util
 from tqdm import tqdm
 from concurrent.futures import ThreadPoolExecutor, as_completed
+import numpy as np
 import pandas as pd
 
 from .hue import Notebook
-from ..settings import MAX_LEN_PRINT_SQL, HUE_DOWNLOAD_LARGE_TABLE_ROWS, \
-    HUE_MAX_CONCURRENT_SQL, HIVE_PERFORMANCE_SETTINGS, PROGRESSBAR, EXCEL_ENGINE
-from ..utils import append_df_to_csv
+from .poller import StatusPoller
+from .pool import NotebookPool
+from .cache import ResultCache, CachedResult
+from .manifest import DownloadManifest
+from .stats import RowCounter
+from ..settings import MAX_LEN_PRINT_SQL, HUE_DOWNLOAD_LARGE_TABLE_ROWS, HUE_DOWNLOAD_HASH_SPLIT_FILL, \
+    HUE_DOWNLOAD_MAX_COLUMNS, HUE_MAX_CONCURRENT_SQL, HIVE_PERFORMANCE_SETTINGS, PROGRESSBAR, EXCEL_ENGINE
+from ..utils import merge_csv_files
 from .. import logger
 
 __all__ = []
@@ -23,11 +31,16 @@ if importlib.util.find_spec("requests_toolbelt"):
     from .hue_download import HueDownload
     __all__.extend(["hue", "Notebook", "HueDownload"])
 
+if importlib.util.find_spec("aiohttp"):
+    from .aio import AsyncNotebook, AsyncNotebookResult
+    __all__.extend(["AsyncNotebook", "AsyncNotebookResult"])
+
 
 class hue:
     def __init__(self, username: str, password: str = None,
                  name="", description="",
                  hive_settings=None,
+                 result_cache: Union[bool, ResultCache] = False,
                  verbose=False):
 
         # global hue_sys, download
@@ -50,8 +63,20 @@ class hue:
                                 hive_settings=hive_settings,
                                 verbose=False)
         self.hue_download = HueDownload(username, password, verbose)
-
-        self.notebook_workers = [self.hue_sys]
+        # opt-in on-disk cache of query results, see hue.cache.ResultCache
+        if result_cache is True:
+            result_cache = ResultCache(verbose=verbose)
+        self.result_cache = result_cache or None
+
+        self.notebook_pool = NotebookPool(self.hue_sys,
+                                          size=HUE_MAX_CONCURRENT_SQL,
+                                          name=self.name,
+                                          description=self.description,
+                                          verbose=self.hue_sys.verbose)
+        # workers created by notebook_pool so far
+        self.notebook_workers = self.notebook_pool.workers
+        # table sizes from metastore statistics, see hue.stats.RowCounter
+        self.row_counter = RowCounter(self, verbose=verbose)
 
     def run_sql(self,
                 sql: str,
@@ -60,7 +85,8 @@ class hue:
                 progressbar: bool = True,
                 progressbar_offset: int = 0,
                 sync=True,
-                new_notebook=False):
+                new_notebook=False,
+                use_cache=True):
         """
         Run HiveQL using hue Notebook API
 
@@ -76,8 +102,11 @@ class hue:
                      default to True
         :param new_notebook: whether to initialize a new notebook
                              default to False
+        :param use_cache: whether to read and write result of query in self.result_cache
+                          if it is enabled, default to True
 
-        :return: hue.NotebookResult, which handles result of corresponding sql query
+        :return: hue.NotebookResult, which handles result of corresponding sql query,
+                 or hue.cache.CachedResult if result is read from cache
         """
         if new_notebook:
             nb = self.hue_sys.new_notebook(self.name,
@@ -87,12 +116,23 @@ class hue:
         else:
             nb = self.hue_sys
 
-        return nb.execute(sql,
-                          database=database,
-                          print_log=print_log,
-                          progressbar=progressbar,
-                          progressbar_offset=progressbar_offset,
-                          sync=sync)
+        cache_key = None
+        if self.result_cache is not None and use_cache and sync and ResultCache.is_cacheable(sql):
+            cache_key = self.result_cache.key(sql, database, nb.hive_settings)
+            cache_path = self.result_cache.get(cache_key)
+            if cache_path is not None:
+                return CachedResult(cache_path, name=self.name, verbose=self.verbose)
+
+        result = nb.execute(sql,
+                            database=database,
+                            print_log=print_log,
+                            progressbar=progressbar,
+                            progressbar_offset=progressbar_offset,
+                            sync=sync)
+        if cache_key is not None:
+            # result is cached once it is fully iterated
+            result._cache = (self.result_cache, cache_key)
+        return result
 
     def run_notebook_sql(self, *args, **kwargs):
         return self.run_sql(*args, **kwargs)
@@ -113,51 +153,92 @@ class hue:
         :param sqls: iterable instance of sql strings
         :param database: string, default "default", database name
         :param n_jobs: number of concurrent queries to run, it is recommended not greater than 4,
-                       otherwise it would sometimes causes "Too many opened sessions" error
+                       otherwise it would sometimes causes "Too many opened sessions" error,
+                       this is also the number of notebooks reused to run the queries
         :param wait_sec: wait seconds between submission of query
         :param progressbar: whether to show progress bar during waiting
         :param progressbar_offset: use this parameter to control sql progressbar positions
-        :param sync: whether to wait for all queries to complete execution
+        :param sync: whether to wait for all queries to complete execution,
+                     if False, results are returned once queries are submitted, n_jobs at a time
 
         :return: list of NotebookResults
         """
 
-        # setup logging level
-        while len(self.notebook_workers) < len(sqls):
-            self.notebook_workers.append(
-                self.hue_sys.new_notebook(
-                    self.name + f"-worker-{len(self.notebook_workers)}",
-                    self.description,
-                    hive_settings=None,
-                    recreate_session=False,
-                    verbose=self.hue_sys.verbose)
-            )
+        # at most n_jobs notebooks are checked out at the same time
+        self.notebook_pool.size = n_jobs
 
         # go for concurrent sql run
         i = 0
-        d_future = {}
         lst_result = [None] * len(sqls)
         if progressbar:
             setup_pbar = PROGRESSBAR.copy()
-            if "desc" in setup_progressbar:
+            if "desc" in setup_pbar:
                 del setup_pbar["desc"]
             pbar = tqdm(total=len(sqls), desc=desc,
                 position=progressbar_offset, **setup_pbar)
 
-        while i < len(sqls) or len(d_future) > 0:
-            # check and collect completed results
-            for notebook, idx in list(d_future.items()):
-                result = notebook._result
-                try:
-                    result.check_status()
-                    if sync and not result.is_ready():
-                        continue
+        # status of executed sqls are polled in background,
+        # submission only waits for a vacancy in job pool
+        poller = StatusPoller(n_threads=min(n_jobs, len(sqls)),
+                              wait_ready=sync,
+                              verbose=self.verbose)
+        # id -> worker checked out and not returned yet
+        in_flight = {}
+        try:
+            while i < len(sqls) or len(poller) > 0:
+                # add task to job pool when there exists vacancy,
+                # without sync a worker is returned once its sql is submitted and polled
+                while i < len(sqls) and len(poller) < n_jobs:
+                    worker = None
+                    try:
+                        # never block on checkout while holding workers of finished sqls,
+                        # a concurrent run_sqls may wait for them, collect them first
+                        try:
+                            worker = self.notebook_pool.checkout(timeout=0) if len(poller) \
+                                else self.notebook_pool.checkout()
+                        except TimeoutError:
+                            if len(poller):
+                                break
+                            raise
+
+                        in_flight[id(worker)] = worker
+                        result = worker.execute(sqls[i],
+                                                database=database,
+                                                progressbar=False,
+                                                sync=False)
+                        poller.submit((i, worker), result)
+                    except Exception as e:
+                        if worker is None and isinstance(e, TimeoutError):
+                            # pool is exhausted
+                            raise
+                        if worker is not None:
+                            del in_flight[id(worker)]
+                            self.notebook_pool.checkin(worker, close_statement=True, broken=True)
+                        self.log.warning(e)
+                        self.log.warning(
+                            f"due to execute exception above, "
+                            f"result of the following sql is truncated: "
+                            f"{sqls[i][: MAX_LEN_PRINT_SQL] + '...' if len(sqls[i]) > MAX_LEN_PRINT_SQL else sqls[i]}")
+                        lst_result[i] = e
+                        if progressbar:
+                            pbar.update(1)
 
+                    i += 1
+                    if wait_sec > 0 and i < len(sqls):
+                        time.sleep(wait_sec)
+
+                if len(poller) == 0:
+                    continue
+
+                # collect completed results
+                (idx, worker), result, e = poller.get()
+                del in_flight[id(worker)]
+                # statement of a successful result is kept for fetching,
+                # it is closed once rows are consumed and worker is reused
+                self.notebook_pool.checkin(worker, result=result, close_statement=e is not None)
+                if e is None:
                     lst_result[idx] = result
-                    del d_future[notebook]
-                    if progressbar:
-                        pbar.update(1)
-                except Exception as e:
+                else:
                     self.log.warning(e)
                     sql = sqls[idx]
                     self.log.warning(
@@ -165,32 +246,14 @@ class hue:
                         f"result of the following sql is truncated: "
                         f"{sql[: MAX_LEN_PRINT_SQL] + '...' if len(sql) > MAX_LEN_PRINT_SQL else sql}")
                     lst_result[idx] = e
-                    del d_future[notebook]
-                    if progressbar:
-                        pbar.update(1)
 
-            # add task to job pool when there exists vacancy
-            while i < len(sqls) and (len(d_future) < n_jobs or not sync):
-                worker = self.notebook_workers[i]
-                try:
-                    result = worker.execute(sqls[i],
-                                            database=database,
-                                            progressbar=False,
-                                            sync=False)
-                    d_future[worker] = i
-                except Exception as e:
-                    self.log.warning(e)
-                    self.log.warning(
-                        f"due to execute exception above, "
-                        f"result of the following sql is truncated: "
-                        f"{sqls[i][: MAX_LEN_PRINT_SQL] + '...' if len(sqls[i]) > MAX_LEN_PRINT_SQL else sqls[i]}")
-                    lst_result[i] = e
-                    if progressbar:
-                        pbar.update(1)
-                finally:
-                    i += 1
-
-            time.sleep(wait_sec)
+                if progressbar:
+                    pbar.update(1)
+        finally:
+            # interrupted, release statements still running so that their workers can be reused
+            for worker in in_flight.values():
+                self.notebook_pool.checkin(worker, close_statement=True)
+            poller.close()
 
         if progressbar:
             pbar.close()
@@ -215,6 +278,10 @@ class hue:
                  progressbar_offset: int = 0,
                  print_log: bool = False,
                  check_table_size: Union[bool, int] = True,
+                 split: str = "hash",
+                 split_key: Union[str, list] = None,
+                 resume: bool = False,
+                 max_columns: int = HUE_DOWNLOAD_MAX_COLUMNS,
                  info_kwargs: dict = None
                  ):
         """
@@ -237,68 +304,208 @@ class hue:
         :param print_log: whether to print cloud log to console
         :param check_table_size: default to True, whether to determine if table's number of rows
             exceeds limitation of HueDownload platform, pass the number of row if you know the exact size
+        :param split: how a large table is split into chunks of temporary tables,
+            "hash" (default) to split by pmod(hash(split_key), number of chunks), chunks are filled
+            by a parallel multi-insert without global ordering, their sizes vary slightly,
+            "row_number" to split by ROW_NUMBER() OVER (), which sorts the whole table in one reducer,
+            use it when exact chunk sizes matter
+        :param split_key: column name, list of column names or expression to hash when split is "hash",
+            e.g. partition or bucket columns of the table if they are evenly distributed,
+            default to all downloaded columns
+        :param resume: default to False, whether a large table download can be resumed,
+            progress of chunks is recorded in a manifest next to path ({path}.wfdl.json),
+            when the download fails, temporary tables and downloaded chunks are kept,
+            call again with resume=True to download only the chunks that are missing or corrupt,
+            the split insert is skipped if the temporary tables still exist
+        :param max_columns: tables with more columns are downloaded in column shards in parallel,
+            which are stitched row by row into the output file
         :param info_kwargs: to modify default get_info_by_id parameters, add argument pairs here
                             (useful when downloadables cannot be found in just one page)
 
         :return: Pandas.DataFrame if path is not specified,
                  otherwise output file to path and return None
         """
+        if split not in ("hash", "row_number"):
+            raise ValueError(f"split should be either 'hash' or 'row_number', got '{split}'")
+        if resume and not path:
+            raise ValueError("resume requires path, chunks and their manifest are saved next to it")
 
         if path:
             dir_path = os.path.dirname(path)
             if not os.path.exists(dir_path):
                 raise NotADirectoryError(f"path does not exist: '{path}'")
 
-        if isinstance(check_table_size, bool) and check_table_size:
-            self.log.info(f"checking size of table {table}")
-            table_rows = (self
-                .run_sql(f"select count(*) from {table}", progressbar=False, new_notebook=True)
-                .fetchall(progressbar=False)["data"][0][0])
-            self.log.info(f"got {table} table size {table_rows}")
-        elif isinstance(check_table_size, int):
-            table_rows = check_table_size
-
-        if not check_table_size \
-            or table_rows <= HUE_DOWNLOAD_LARGE_TABLE_ROWS:
-            if isinstance(info_kwargs, dict) and len(info_kwargs):
-                return self.hue_download.download(
-                    table=table,
-                    reason=reason,
-                    columns=columns,
-                    column_names=column_names,
-                    decrypt_columns=decrypt_columns,
-                    path=path,
-                    **info_kwargs)
+        manifest_path = f"{path}.wfdl.json"
+        manifest_options = {"columns": columns,
+                            "decrypt_columns": decrypt_columns,
+                            "split": split,
+                            "split_key": split_key}
+        manifest = DownloadManifest.load(manifest_path, table, manifest_options, verbose=self.verbose) \
+            if resume else None
+
+        table_rows = None
+        if manifest is None:
+            if isinstance(check_table_size, bool) and check_table_size:
+                table_rows = self._count_rows(table)
+            elif isinstance(check_table_size, int):
+                table_rows = check_table_size
+
+            if not check_table_size \
+                or table_rows <= HUE_DOWNLOAD_LARGE_TABLE_ROWS:
+                if isinstance(info_kwargs, dict) and len(info_kwargs):
+                    return self.hue_download.download(
+                        table=table,
+                        reason=reason,
+                        columns=columns,
+                        column_names=column_names,
+                        decrypt_columns=decrypt_columns,
+                        path=path,
+                        max_columns=max_columns,
+                        **info_kwargs)
+                else:
+                    return self.hue_download.download(
+                        table=table,
+                        reason=reason,
+                        columns=columns,
+                        column_names=column_names,
+                        decrypt_columns=decrypt_columns,
+                        path=path,
+                        max_columns=max_columns)
+
+            self.log.info(f"downloading large table '{table}'. split into chunks and batch download")
+            manifest = DownloadManifest(manifest_path, table, manifest_options, verbose=self.verbose)
+        else:
+            self.log.info(f"resuming download of large table '{table}' from '{manifest_path}'")
+
+        str_drop_tmp_table = "drop table if exists {}"
+        try:
+            lst_pending = [chunk for chunk in manifest.chunks if not manifest.is_complete(chunk)]
+            if len(manifest.chunks) == 0 \
+                    or (len(lst_pending) and not (manifest.inserted and self._tables_exist(manifest.tmp_tables))):
+                if len(manifest.tmp_tables):
+                    self.log.info("temporary tables are gone, splitting table again")
+                    self.run_sqls([str_drop_tmp_table.format(t) for t in manifest.tmp_tables], progressbar=False)
+
+                self._split_table(manifest,
+                                  table_rows=table_rows or self._count_rows(table),
+                                  columns=columns,
+                                  split=split,
+                                  split_key=split_key,
+                                  path=path,
+                                  progressbar=progressbar,
+                                  progressbar_offset=progressbar_offset,
+                                  print_log=print_log)
+                lst_pending = manifest.chunks
+            elif len(lst_pending):
+                self.log.info(f"reusing temporary tables, {len(lst_pending)} of {len(manifest.chunks)} "
+                              f"chunks to download")
+
+            if len(lst_pending):
+                self.log.info("downloading chunks")
+                self._download_chunks(manifest,
+                                      lst_pending,
+                                      reason=reason,
+                                      columns=columns,
+                                      decrypt_columns=decrypt_columns,
+                                      max_columns=max_columns,
+                                      n_jobs=n_jobs,
+                                      progressbar=progressbar,
+                                      progressbar_offset=progressbar_offset,
+                                      info_kwargs=info_kwargs)
+
+            self.log.info("merging chunks")
+            if os.path.isfile(path):
+                os.remove(path)
+
+            lst_paths = [chunk["path"] for chunk in manifest.chunks]
+            # chunks share the same columns, concatenate bytes without parsing
+            merge_csv_files(lst_paths, path, column_names=column_names, encoding="utf-8")
+        except Exception as e:
+            self.log.exception(e)
+            if resume:
+                self.log.warning(f"download of '{table}' failed, temporary tables and chunks are kept, "
+                                 f"call again with resume=True to download the rest")
             else:
-                return self.hue_download.download(
-                    table=table,
-                    reason=reason,
-                    columns=columns,
-                    column_names=column_names,
-                    decrypt_columns=decrypt_columns,
-                    path=path)
-
-        self.log.info(f"downloading large table '{table}'. split into chunks and batch download")
-        # pre-execute preparation
+                self.log.info("cleaning up caches")
+                if len(manifest.tmp_tables):
+                    self.run_sqls([str_drop_tmp_table.format(t) for t in manifest.tmp_tables], progressbar=False)
+                manifest.remove()
+            raise e
+
+        self.log.info("cleaning up temporary tables")
+        for chunk_path in lst_paths:
+            os.remove(chunk_path)
+        self.run_sqls([str_drop_tmp_table.format(t) for t in manifest.tmp_tables], progressbar=False)
+        manifest.remove()
+
+    def _count_rows(self, table: str):
+        self.log.info(f"checking size of table {table}")
+        table_rows = self.row_counter.count(table)
+        self.log.info(f"got {table} table size {table_rows}")
+        return table_rows
+
+    def _tables_exist(self, tables: list):
+        lst_sqls = []
+        for database, tables_in_db in itertools.groupby(sorted(t.rpartition('.')[::2] for t in tables),
+                                                        key=lambda t: t[0]):
+            patterns = "|".join(name for _, name in tables_in_db)
+            lst_sqls.append(f"show tables in {database} like '{patterns}'" if database
+                            else f"show tables like '{patterns}'")
+
+        existing = set()
+        for res in self.run_sqls(lst_sqls, progressbar=False):
+            existing.update(row[0].lower() for row in res.fetchall(progressbar=False)["data"])
+
+        return all(t.rpartition('.')[-1].lower() in existing for t in tables)
+
+    def _split_table(self,
+                     manifest: DownloadManifest,
+                     table_rows: int,
+                     columns: list,
+                     split: str,
+                     split_key: Union[str, list],
+                     path: str,
+                     progressbar: bool,
+                     progressbar_offset: int,
+                     print_log: bool):
+        """
+        split table into temporary tables no larger than HueDownload's limit by a multi-insert,
+        manifest is reset to the new temporary tables
+        """
+        table = manifest.table
         database, dot, _ = table.rpartition('.')
         str_tmp_table = f"{database}.{self.username}" if len(dot) else f"{self.username}"
         str_tmp_table += "_tmp_{}"
         str_create_tmp_table = "create table {} like " + table
-        str_drop_tmp_table = "drop table if exists {}"
         lst_tmp_tables = []
-        lst_create_tmp_table = []
-        lst_drop_tmp_table = []
-        str_insert_tmp_table_query = f"from (select *, ROW_NUMBER() OVER () as tmp_row from {table}) t"
-        for i in range(1, table_rows + 1, HUE_DOWNLOAD_LARGE_TABLE_ROWS):
+        if split == "hash":
+            if split_key is None:
+                split_key = columns or self.hue_download.get_column(table)
+            if not isinstance(split_key, str):
+                split_key = ", ".join(f"`{col}`" for col in split_key)
+
+            n_chunks = self._count_hash_buckets(table, table_rows, split_key,
+                                                progressbar=progressbar,
+                                                progressbar_offset=progressbar_offset,
+                                                print_log=print_log)
+            str_insert_tmp_table_query = \
+                f"from (select *, pmod(hash({split_key}), {n_chunks}) as tmp_row from {table}) t"
+            lst_conditions = [f"tmp_row = {i}" for i in range(n_chunks)]
+        else:
+            str_insert_tmp_table_query = f"from (select *, ROW_NUMBER() OVER () as tmp_row from {table}) t"
+            lst_conditions = [f"tmp_row between {i} and {i + HUE_DOWNLOAD_LARGE_TABLE_ROWS - 1}"
+                              for i in range(1, table_rows + 1, HUE_DOWNLOAD_LARGE_TABLE_ROWS)]
+
+        for condition in lst_conditions:
             tmp_table = str_tmp_table.format(int(time.time() * 1000))
             lst_tmp_tables.append(tmp_table)
-            lst_create_tmp_table.append(str_create_tmp_table.format(tmp_table))
-            lst_drop_tmp_table.append(str_drop_tmp_table.format(tmp_table))
             str_insert_tmp_table_query += \
-                f"\ninsert into table {tmp_table} select `(tmp_row)?+.+` where tmp_row between {i} and {i + 99999}"
+                f"\ninsert into table {tmp_table} select `(tmp_row)?+.+` where {condition}"
 
             time.sleep(1e-3)
 
+        manifest.reset(lst_tmp_tables, [f"{path}.wfdl{i}" for i in range(len(lst_tmp_tables))])
+
         b_backtick_as_regex = False
         if "hive.support.quoted.identifiers" in self.hue_sys.hive_settings \
                 and self.hue_sys.hive_settings["hive.support.quoted.identifiers"] == "none":
@@ -306,56 +513,127 @@ class hue:
 
         self.log.info(f"creating temporary table for '{table}'")
         try:
-            self.run_sqls(lst_create_tmp_table, progressbar=False)
+            self.run_sqls([str_create_tmp_table.format(t) for t in lst_tmp_tables], progressbar=False)
             self.hue_sys.set_backtick(as_regex=True)
             self.hue_sys.set_hive("tez.grouping.split-count", str(len(lst_tmp_tables) * 5 + 1))
             self.run_sql(str_insert_tmp_table_query,
                          progressbar=progressbar,
                          progressbar_offset=progressbar_offset,
                          print_log=print_log)
-
-            self.log.info("downloading chunks")
-            lst_paths = [f"{path}.wfdl{i}" for i in range(len(lst_tmp_tables))]
-            if isinstance(info_kwargs, dict) and "size" in info_kwargs:
-                info_kwargs["size"] += len(lst_tmp_tables)
-            elif isinstance(info_kwargs, dict):
-                info_kwargs["size"] = len(lst_tmp_tables)
-
-            self.batch_download(lst_tmp_tables,
-                                reasons=reason,
-                                columns=[columns] * len(lst_tmp_tables),
-                                decrypt_columns=[decrypt_columns] * len(lst_tmp_tables),
-                                paths=lst_paths,
-                                n_jobs=n_jobs,
-                                check_table_size=False,
-                                progressbar=progressbar,
-                                progressbar_offset=progressbar_offset,
-                                info_kwargs=info_kwargs)
-        except Exception as e:
-            self.run_sqls(lst_drop_tmp_table, progressbar=False)
+        finally:
             self.hue_sys.unset_hive("tez.grouping.split-count")
             if not b_backtick_as_regex:
                 self.hue_sys.set_backtick(as_regex=False)
-            raise e
 
-        self.hue_sys.unset_hive("tez.grouping.split-count")
-        if not b_backtick_as_regex:
-            self.hue_sys.set_backtick(as_regex=False)
+        manifest.inserted = True
+        manifest.save()
 
-        self.log.info("merging chunks")
-        if os.path.isfile(path):
-            os.remove(path)
+    def _count_hash_buckets(self,
+                            table: str,
+                            table_rows: int,
+                            split_key: str,
+                            progressbar: bool,
+                            progressbar_offset: int,
+                            print_log: bool):
+        """
+        decide number of hash buckets of table, bucket sizes are checked by a grouped count,
+        and buckets are added once if the largest exceeds HueDownload's limit
 
-        try:
-            for excel in lst_paths:
-                df = pd.read_csv(excel, encoding="utf-8")
-                append_df_to_csv(path, df, encoding="utf-8", index=False)
-                os.remove(excel)
-        except Exception as e:
-            self.log.exception(e)
-            self.log.info("cleaning up caches")
-            self.run_sqls(lst_drop_tmp_table, progressbar=False)
-            raise e
+        :return: number of hash buckets
+        """
+        # hash buckets are filled below the row limit of HueDownload, as their sizes vary
+        n_chunks = math.ceil(table_rows / (HUE_DOWNLOAD_LARGE_TABLE_ROWS * HUE_DOWNLOAD_HASH_SPLIT_FILL))
+        for attempt in range(2):
+            res = self.run_sql(f"select pmod(hash({split_key}), {n_chunks}), count(*) from {table} "
+                               f"group by pmod(hash({split_key}), {n_chunks})",
+                               progressbar=progressbar,
+                               progressbar_offset=progressbar_offset,
+                               print_log=print_log,
+                               use_cache=False)
+            lst_rows = [int(n_rows) for _, n_rows in res.fetchall(progressbar=False)["data"]]
+            max_rows = max(lst_rows, default=0)
+            if max_rows <= HUE_DOWNLOAD_LARGE_TABLE_ROWS:
+                return n_chunks
+            if attempt > 0:
+                break
+
+            self.log.warning(f"hash bucket of {max_rows} rows exceeds download limit "
+                             f"of {HUE_DOWNLOAD_LARGE_TABLE_ROWS} rows, splitting '{table}' into more buckets")
+            # enough buckets for the largest one to fit
+            n_chunks = math.ceil(n_chunks * max_rows / (HUE_DOWNLOAD_LARGE_TABLE_ROWS * HUE_DOWNLOAD_HASH_SPLIT_FILL))
+
+        raise RuntimeError(f"cannot split '{table}' into chunks of at most {HUE_DOWNLOAD_LARGE_TABLE_ROWS} rows, "
+                           f"rows are skewed on split_key, try another split_key or split='row_number'")
+
+    def _download_chunks(self,
+                         manifest: DownloadManifest,
+                         chunks: list,
+                         reason: str,
+                         columns: list,
+                         decrypt_columns: list,
+                         max_columns: int,
+                         n_jobs: int,
+                         progressbar: bool,
+                         progressbar_offset: int,
+                         info_kwargs: dict):
+        """
+        download chunks of temporary tables concurrently, recording them in manifest
+        """
+        n_columns = len(columns or self.hue_download.get_column(manifest.table))
+
+        def download_chunk(chunk):
+            if n_columns > max_columns:
+                # chunk of a wide table is downloaded in column shards, each with its own download id
+                self.hue_download.download(table=chunk["table"],
+                                           reason=reason,
+                                           columns=columns,
+                                           decrypt_columns=decrypt_columns,
+                                           path=chunk["path"],
+                                           max_columns=max_columns,
+                                           **(info_kwargs or {}))
+                manifest.commit(chunk)
+                return
+
+            if chunk["download_id"] is not None:
+                # the prepared download may still be on server
+                try:
+                    self.hue_download.download_by_id(chunk["download_id"], path=chunk["path"])
+                    manifest.commit(chunk)
+                    return
+                except Exception as e:
+                    self.log.warning(f"cannot download {chunk['table']} by id {chunk['download_id']}, "
+                                     f"preparing it again: {e}")
+
+            download_id = self.hue_download.prepare(table=chunk["table"],
+                                                    reason=reason,
+                                                    columns=columns,
+                                                    decrypt_columns=decrypt_columns,
+                                                    **(info_kwargs or {}))
+            manifest.set_download_id(chunk, download_id)
+            self.hue_download.download_by_id(download_id, path=chunk["path"])
+            manifest.commit(chunk)
+
+        if progressbar:
+            setup_pbar = PROGRESSBAR.copy()
+            setup_pbar["desc"] = "batch downloading"
+            pbar = tqdm(total=len(chunks), miniters=0, position=progressbar_offset, **setup_pbar)
+
+        lst_failed = []
+        with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+            d_future = {executor.submit(download_chunk, chunk): chunk for chunk in chunks}
+            for future in as_completed(d_future):
+                if future.exception() is not None:
+                    self.log.warning(f"failed to download {d_future[future]['table']}: {future.exception()}")
+                    lst_failed.append(d_future[future]["table"])
+
+                if progressbar:
+                    pbar.update(1)
+
+        if progressbar:
+            pbar.close()
+
+        if len(lst_failed):
+            raise RuntimeError(f"failed to download {len(lst_failed)} of {len(chunks)} chunks: {lst_failed}")
 
     def batch_download(self,
                        tables: list,
@@ -406,18 +684,16 @@ class hue:
 
         if not use_hue and check_table_size:
             self.log.info(f"checking table sizes for {tables}")
-            lst_size = self.run_sqls([f"select count(*) from {table}" for table in tables],
-                desc="checking table sizes", progressbar=progressbar, progressbar_offset=progressbar_offset)
-            lst_size = [res.fetchall(progressbar=False)["data"][0][0] for res in lst_size]
+            lst_size = self.row_counter.count(tables, progressbar=progressbar, progressbar_offset=progressbar_offset)
             self.log.info("got table size " + 
                 '\t'.join([f'{t}:{s}' for t, s in zip(tables, lst_size)]))
         elif use_hue and check_table_size and isinstance(decrypt_columns, list) and any(decrypt_columns):
             lst_size = [len(cols) > 0 if isinstance(cols, list) else False for cols in decrypt_columns]
             lst_check_table = [table for table, check in zip(tables, lst_size) if check]
             self.log.info(f"checking table sizes for {lst_check_table}")
-            lst_check_table_size = self.run_sqls([f"select count(*) from {table}" for table in lst_check_table],
-                desc="checking table sizes", progressbar=progressbar, progressbar_offset=progressbar_offset)
-            lst_check_table_size = [res.fetchall(progressbar=False)["data"][0][0] for res in lst_check_table_size]
+            lst_check_table_size = self.row_counter.count(lst_check_table,
+                                                          progressbar=progressbar,
+                                                          progressbar_offset=progressbar_offset)
             self.log.info("got table size " + 
                 '\t'.join([f'{t}:{s}' for t, s in zip(lst_check_table, lst_check_table_size)]))
             lst_size = [lst_check_table_size.pop(0) if check else False for check in lst_size]
@@ -435,9 +711,6 @@ class hue:
 
         if use_hue:
             n_jobs = max(n_jobs, HUE_MAX_CONCURRENT_SQL)
-        elif n_jobs > 10 and ("size" not in info_kwargs
-                or info_kwargs["size"] < n_jobs):
-            info_kwargs["size"] = n_jobs + 1
 
         d_future = {}
         with ThreadPoolExecutor(max_workers=n_jobs) as executor:
@@ -520,13 +793,15 @@ class hue:
                timeout: float = float("inf"),
                table_name: str = None,
                if_table_exists: str = "raise",
+               file_format: str = "csv",
+               shards: int = 1,
                **info_kwargs
                ):
         """
         a refactored version of upload_data from WxCustom
         parse upload data and call upload API, if success, return uploaded table name.
 
-        :param data: pandas.DataFrame, pandas.Series or path str to xlsx, xls or csv file
+        :param data: pandas.DataFrame, pandas.Series or path str to xlsx, xls, csv or parquet file
         :param reason: str, upload reason
         :param columns: list, list of columns to upload
         :param column_names: list, list of column with respective to their alias,
@@ -539,6 +814,11 @@ class hue:
         :param table_name: str, user can nominate final table name
         :param if_table_exists: str, method behavior if renaming to table_name returns any error
             "raise" to raise error, "silent" to return name of uploaded table as usual
+        :param file_format: "csv" (default) or "xlsx", format DataFrame and parquet are uploaded in,
+                            csv is streamed in chunks, xlsx is built in memory and much slower
+        :param shards: number of row shards DataFrame is split into and uploaded concurrently,
+            shard tables are then combined by one insert into the first shard and dropped,
+            default to 1, upload as a whole
         :param info_kwargs: to modify get_info_by_id parameters, add argument pairs here
 
         :return: str, name of uploaded table
@@ -546,14 +826,18 @@ class hue:
         if if_table_exists not in ('raise', 'silent', 'replace'):
             raise ValueError("if_table_exists only accept 'raise', 'silent' or 'replace'")
 
-        uploaded_table = self.hue_download.upload(data=data,
-                                                  reason=reason,
-                                                  columns=columns,
-                                                  column_names=column_names,
-                                                  encrypt_columns=encrypt_columns,
-                                                  wait_sec=wait_sec,
-                                                  timeout=timeout,
-                                                  **info_kwargs)
+        upload_kwargs = dict(reason=reason,
+                             columns=columns,
+                             column_names=column_names,
+                             encrypt_columns=encrypt_columns,
+                             wait_sec=wait_sec,
+                             timeout=timeout,
+                             file_format=file_format,
+                             **info_kwargs)
+        if shards > 1:
+            uploaded_table = self._upload_shards(data, shards, **upload_kwargs)
+        else:
+            uploaded_table = self.hue_download.upload(data=data, **upload_kwargs)
         if table_name is None:
             self.log.info('data has uploaded to table ' + uploaded_table)
             return uploaded_table
@@ -577,6 +861,56 @@ class hue:
                     return table_name
             raise e
 
+    def _upload_shards(self, data, shards: int, **upload_kwargs):
+        """
+        upload row shards of DataFrame concurrently and union them into the first shard table
+        """
+        if isinstance(data, pd.Series):
+            data = data.to_frame()
+        if not isinstance(data, pd.DataFrame):
+            raise TypeError(f"shards requires data to be pandas.DataFrame or pandas.Series, got {type(data)}")
+
+        shards = min(shards, max(len(data), 1))
+        bounds = np.linspace(0, len(data), shards + 1).astype(int)
+        # concurrent uploads must all be found on the listing page
+        upload_kwargs["size"] = max(upload_kwargs.get("size", 10), shards + 10)
+
+        self.log.info(f"uploading {len(data)} rows in {shards} shards")
+        lst_tables = [None] * shards
+        lst_errors = []
+        with ThreadPoolExecutor(max_workers=shards) as executor:
+            d_future = {executor.submit(self.hue_download.upload, data=data.iloc[start: end], **upload_kwargs): i
+                        for i, (start, end) in enumerate(zip(bounds[:-1], bounds[1:]))}
+            for future in as_completed(d_future):
+                try:
+                    uploaded_table = future.result()
+                    if isinstance(uploaded_table, Exception):
+                        raise uploaded_table
+                    lst_tables[d_future[future]] = uploaded_table
+                except Exception as e:
+                    self.log.warning(f"failed to upload shard {d_future[future]}: {e}")
+                    lst_errors.append(e)
+
+        lst_uploaded = [table for table in lst_tables if table is not None]
+        if len(lst_errors):
+            if len(lst_uploaded):
+                self.run_sqls([f"drop table if exists {table}" for table in lst_uploaded], progressbar=False)
+            raise lst_errors[0]
+
+        if shards == 1:
+            return lst_tables[0]
+
+        self.log.info(f"combining {shards} shard tables into {lst_tables[0]}")
+        union = "\nunion all\n".join(f"select * from {table}" for table in lst_tables[1:])
+        try:
+            self.run_sql(f"insert into table {lst_tables[0]}\nselect * from ({union}) t", progressbar=False)
+        except Exception as e:
+            self.run_sqls([f"drop table if exists {table}" for table in lst_tables], progressbar=False)
+            raise e
+
+        self.run_sqls([f"drop table if exists {table}" for table in lst_tables[1:]], progressbar=False)
+        return lst_tables[0]
+
     def insert_data(self,
                     data,
                     table_name: str,
@@ -585,6 +919,7 @@ class hue:
                     column_names: list = None,
                     encrypt_columns: list = None,
                     drop: bool = True,
+                    shards: int = 1,
                     progressbar: bool = True,
                     progressbar_offset: int = 0
                     ):
@@ -599,6 +934,7 @@ class hue:
         :param encrypt_columns: list, list of columns to encrypt during upload
         :param reason: str, upload reason
         :param drop: whether to drop uploaded temporary table once insertion succeeds
+        :param shards: number of row shards DataFrame is uploaded in concurrently, see self.upload
         :param progressbar: whether to show procedure progressbars
         :param progressbar_offset: position of tqdm progressbars
 
@@ -609,7 +945,8 @@ class hue:
                                      reason=reason,
                                      columns=columns,
                                      column_names=column_names,
-                                     encrypt_columns=encrypt_columns)
+                                     encrypt_columns=encrypt_columns,
+                                     shards=shards)
         try:
             self.run_sql(f'insert into table {table_name} select * from {uploaded_table}',
                          progressbar=progressbar,
@@ -636,6 +973,7 @@ class hue:
                   use_hue: bool = False,
                   new_notebook: bool = False,
                   rows_per_fetch: int = 32768,
+                  max_columns: int = HUE_DOWNLOAD_MAX_COLUMNS,
                   progressbar: bool = True,
                   progressbar_offset: int = 0,
                   info_kwargs: dict = None
@@ -650,14 +988,19 @@ class hue:
         :param column_names: rename column names if needed
         :param decrypt_columns: columns to be decrypted
         :param path: default None, path to save table data,
-                     if path is given, the method will return None
+                     if path is given, the method will return None.
+                     when use_hue is True, .csv is streamed from Hue's result export,
+                     .parquet and .feather files are written page by page in low memory
         :param check_table_size: default to True, whether to determine if table's number of rows
             exceeds limitation of HueDownload platform, pass exact row number if you know the size.
              this is ignored when use_hue is True
         :param encoding: if path is specified, will handle encoding of saved file
         :param use_hue: default False, whether try to fetch specified data from hue
         :param new_notebook: default False, whether to open a new Notebook, this is not designed for user use
-        :param rows_per_fetch: rows to fetch per request, tweak it if encounter "Too many sessions" error
+        :param rows_per_fetch: initial rows to fetch per request, it is adapted afterward
+                               to response size and latency, see settings.HUE_FETCH_ADAPTIVE
+        :param max_columns: tables with more columns are downloaded from HueDownload in column shards,
+            this is ignored when use_hue is True
         :param progressbar: whether to show progress bar during waiting
         :param progressbar_offset: use this parameter to control sql progressbar positions
         :param info_kwargs: to modify get_info_by_id parameters, add argument pairs here
@@ -682,14 +1025,24 @@ class hue:
                                new_notebook=new_notebook)
             res.rows_per_fetch = rows_per_fetch
             if path and suffix == 'csv':
-                res.to_csv(path, column_names=column_names, encoding=encoding)
+                # Hue's export is streamed as is, result is paged only if export is disabled
+                res.download(path, format="csv", column_names=column_names, encoding=encoding,
+                             progressbar=progressbar,
+                             progressbar_offset=progressbar_offset)
+                return
+            if path and suffix in ('parquet', 'pq'):
+                res.to_parquet(path, column_names=column_names,
+                               progressbar=progressbar,
+                               progressbar_offset=progressbar_offset)
+                return
+            if path and suffix in ('feather', 'arrow', 'ipc'):
+                res.to_feather(path, column_names=column_names,
+                               progressbar=progressbar,
+                               progressbar_offset=progressbar_offset)
                 return
 
-            df = pd.DataFrame(**res.fetchall(
-                progressbar=progressbar,
-                progressbar_offset=progressbar_offset
-                )
-            )
+            df = res.to_frame(progressbar=progressbar,
+                              progressbar_offset=progressbar_offset)
             if column_names:
                 if len(df.columns) != len(column_names):
                     self.log.warning(f"length of table columns({len(df.columns)}) "
@@ -714,6 +1067,7 @@ class hue:
                                  decrypt_columns=decrypt_columns,
                                  path=path,
                                  check_table_size=check_table_size,
+                                 max_columns=max_columns,
                                  info_kwargs=info_kwargs)
 
     def kill_app(self, app_id):
@@ -726,7 +1080,5 @@ class hue:
         return self.hue_download.kill_app(app_id)
 
     def close(self):
-        for worker in self.notebook_workers:
-            worker.close()
-
+        self.notebook_pool.close()
         self.hue_sys.logout()
@@ -0,0 +1,595 @@
+import asyncio
+import getpass
+import importlib.util
+import json
+import logging
+import os
+import time
+from collections import deque
+from itertools import chain
+
+import pandas as pd
+
+from .convert import ColumnNormalizer, loads
+from .hue import QueryHandle, FetchSizeController, build_snippet, JOB_LOG_PATTERN
+from .poller import PollSchedule
+from .. import logger
+from ..settings import HUE_BASE_URL, MAX_LEN_PRINT_SQL, HIVE_PERFORMANCE_SETTINGS, HUE_INACTIVE_TIME, \
+    HUE_FETCH_ADAPTIVE, HUE_FETCH_TIMEOUT_SECS, HUE_LOG_MAX_LINES, HUE_LOG_TAIL_LINES, HUE_ASYNC_MAX_CONNECTIONS
+
+if importlib.util.find_spec("aiohttp"):
+    import aiohttp
+    from yarl import URL
+else:
+    aiohttp = None
+
+__all__ = ["AsyncNotebook", "AsyncNotebookResult"]
+
+
+class AsyncNotebook(object):
+    """
+    Asyncio Hue Notebook API, mirrors hue.Notebook.
+    All requests go through one aiohttp connection pool, which is shared with notebooks made by
+    self.new_notebook, and every execution gets its own snippet, so that a single notebook
+    can drive many queries at the same time without a thread per query
+
+    Parameters:
+    username: str, default None
+        Hue username, if not provided here, user need to call self.login manually
+    password: str, Hue password, default None
+        Hue password, if not provided here, user need to call self.login manually
+    name: str, default ""
+        name of Hue notebook
+    description: str, default ""
+        description of Hue notebook
+    base_url: str, default None
+        link to Hue server, default to BASE_URL
+    hive_settings: dict, default PERFORMANT_SETTINGS in settings
+        if you insist on hive default settings, set this parameter to {}
+    max_connections: int, default HUE_ASYNC_MAX_CONNECTIONS in settings
+        size of connection pool
+    verbose: bool, default False
+        whether to print log on stdout, default False
+
+    Example:
+        async with AsyncNotebook(username, password) as nb:
+            results = await asyncio.gather(*(nb.execute(sql) for sql in sqls))
+            df = await results[0].to_frame()
+    """
+
+    def __init__(self,
+                 username: str = None,
+                 password: str = None,
+                 name: str = "",
+                 description: str = "",
+                 base_url: str = None,
+                 hive_settings=None,
+                 max_connections: int = HUE_ASYNC_MAX_CONNECTIONS,
+                 verbose: bool = False):
+        if aiohttp is None:
+            raise ImportError("AsyncNotebook requires aiohttp, please install it via pip")
+
+        self.username = username
+        self._password = password
+        self.name = name
+        self.description = description
+        self.base_url = HUE_BASE_URL if base_url is None else base_url
+        self.hive_settings = HIVE_PERFORMANCE_SETTINGS.copy() \
+            if hive_settings is None else hive_settings
+        self.max_connections = max_connections
+        self.verbose = verbose
+
+        self.log = logging.getLogger(__name__ + f".AsyncNotebook[{name}]")
+        if verbose:
+            logger.set_stream_log_level(self.log, verbose=verbose)
+
+        self.headers = {
+            "Accept": "*/*",
+            "User-Agent": "Mozilla/5.0 (Windows NT 6.1; Win64; x64) "
+                          "AppleWebKit/537.36 (KHTML, like Gecko) "
+                          "Chrome/76.0.3809.100 Safari/537.36",
+        }
+        self._client = None
+        self._owns_client = True
+        self._login_lock = None
+        self._last_execute = None
+        # number of logins, so that requests rejected at the same time log in only once
+        self._n_logins = 0
+
+    async def __aenter__(self):
+        if self.username is not None and self._password is not None:
+            await self.login()
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, tb):
+        await self.close()
+
+    @property
+    def is_logged_in(self):
+        if self._last_execute is None:
+            return False
+
+        return time.perf_counter() - self._last_execute < HUE_INACTIVE_TIME
+
+    @property
+    def client(self):
+        if self._client is None:
+            # hue is usually served by ip address, which default cookie jar refuses
+            self._client = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.max_connections),
+                cookie_jar=aiohttp.CookieJar(unsafe=True))
+            self._login_lock = asyncio.Lock()
+        return self._client
+
+    def _csrftoken(self):
+        cookie = self.client.cookie_jar.filter_cookies(URL(self.base_url)).get("csrftoken")
+        return None if cookie is None else cookie.value
+
+    async def login(self, username: str = None, password: str = None):
+        self.username = username or self.username
+        self._password = password or self._password
+        if self.username is None:
+            raise ValueError("please provide username and password")
+
+        if self._password is None:
+            self._password = getpass.getpass("Please provide Hue password: ")
+
+        self.headers.pop("X-Requested-With", None)
+        self.headers.pop("X-CSRFToken", None)
+
+        self.log.debug(f"logging in for user: [{self.username}]")
+        login_url = self.base_url + '/accounts/login/'
+        async with self.client.get(login_url) as res:
+            await res.read()
+
+        self.headers["Origin"] = self.base_url
+        self.headers["Referer"] = login_url
+        data = {
+            "username": self.username,
+            "password": self._password,
+            "csrfmiddlewaretoken": self._csrftoken()
+        }
+        # if successfully logged in, hue backend will redirect webpage with http 302
+        async with self.client.post(login_url, data=data, headers=self.headers, allow_redirects=False) as res:
+            text = await res.text()
+            status = res.status
+
+        if status != 302 or "errorList" in text:
+            self._password = None
+            self.log.error('login failed for [%s] at %s' % (self.username, self.base_url))
+            raise ValueError('login failed for [%s] at %s' % (self.username, self.base_url))
+
+        self.log.info('login succeeful [%s] at %s' % (self.username, self.base_url))
+        self.headers["X-CSRFToken"] = self._csrftoken()
+        self.headers["X-Requested-With"] = "XMLHttpRequest"
+        self._last_execute = time.perf_counter()
+        self._n_logins += 1
+
+        # requests of login itself never log in again, as login lock might be held by the caller
+        await self._create_notebook(relogin=False)
+        await self._create_session(relogin=False)
+        return self
+
+    async def _relogin(self, n_logins: int):
+        """
+        log in again unless someone else did since n_logins was read
+        """
+        async with self._login_lock:
+            if self._n_logins == n_logins:
+                await self.login()
+
+    async def _request(self,
+                       method: str,
+                       url: str,
+                       attempts: int = 3,
+                       wait_sec: int = 3,
+                       raise_on: tuple = (),
+                       relogin: bool = True,
+                       fail_on_proxy_error: bool = False,
+                       **kwargs):
+        """
+        send request with retries and re-login, like hue.decorators.retry and ensure_login
+
+        :param raise_on: exception types raised at once instead of retried,
+                         for callers that handle them on their own
+        :param relogin: whether to log in when not logged in or login is required,
+                        otherwise raise RuntimeError
+        :param fail_on_proxy_error: whether to raise RuntimeError at once on proxy error response
+        :return: body of response in bytes
+        """
+        client = self.client
+        if not self.is_logged_in:
+            if not relogin:
+                raise RuntimeError(f"not logged in while requesting {url}")
+            self.log.warning(f"not logged in while requesting {url}")
+            await self._relogin(self._n_logins)
+
+        for i in range(1, attempts + 1):
+            n_logins = self._n_logins
+            try:
+                async with client.request(method, url, headers=self.headers, **kwargs) as res:
+                    content = await res.read()
+                    status = res.status
+            except raise_on as e:
+                self.log.warning(f"{type(e).__name__} in {i}/{attempts} attempts, not retried")
+                raise
+            except (asyncio.TimeoutError, aiohttp.ClientError) as e:
+                self.log.warning(f"exception thrown in {i}/{attempts} attempts:")
+                self.log.warning(e)
+                if i == attempts:
+                    raise
+                await asyncio.sleep(wait_sec)
+                continue
+
+            if b"/* login required */" in content or b'"error":"Unauthorized"' in content:
+                if not relogin:
+                    raise RuntimeError(f"login required while requesting {url}")
+                await self._relogin(n_logins)
+                continue
+
+            if status in (200, 201, 204, 301, 302):
+                self._last_execute = time.perf_counter()
+                return content
+
+            self.log.warning(f"response error in {i}/{attempts} attempts: {content[:250]}")
+            if fail_on_proxy_error and b"Proxy Error" in content:
+                raise RuntimeError("the proxy server is down. "
+                                   "perhaps due to large result of sql query")
+            if i < attempts:
+                await asyncio.sleep(wait_sec)
+
+        raise RuntimeError(f"failed to request {url} in {attempts} attempts")
+
+    async def _post(self, path: str, data: dict, **kwargs):
+        content = await self._request("POST", self.base_url + path, data=data, **kwargs)
+        return loads(content)
+
+    async def _create_notebook(self, relogin: bool = True):
+        self.log.debug("creating notebook")
+        r_json = await self._post("/notebook/api/create_notebook",
+                                  {"type": "hive", "directory_uuid": ""},
+                                  relogin=relogin)
+        self.notebook = r_json["notebook"]
+        self.notebook["name"] = self.name
+        self.notebook["description"] = self.description
+
+    async def _create_session(self, relogin: bool = True):
+        self.log.debug("creating session")
+        r_json = await self._post("/notebook/api/create_session", {
+            "notebook": json.dumps({
+                "id": self.notebook.get("id"),
+                "uuid": self.notebook["uuid"],
+                "parentSavedQueryUuid": None,
+                "isSaved": self.notebook["isSaved"],
+                "sessions": self.notebook["sessions"],
+                "type": self.notebook["type"],
+                "name": self.notebook["name"],
+                "description": self.notebook["description"],
+            }),
+            "session": json.dumps({"type": "hive"}),
+        }, relogin=relogin)
+        self.session = r_json["session"]
+        self.notebook["sessions"] = [self.session]
+
+    async def new_notebook(self, name="", description="", hive_settings=None):
+        """
+        create another notebook on Hue that shares connection pool, login and hive session of this one
+        """
+        new_nb = AsyncNotebook(self.username, self._password,
+                               name=name,
+                               description=description,
+                               base_url=self.base_url,
+                               hive_settings=self.hive_settings.copy() if hive_settings is None else hive_settings,
+                               max_connections=self.max_connections,
+                               verbose=self.verbose)
+        new_nb._client = self.client
+        new_nb._owns_client = False
+        new_nb._login_lock = self._login_lock
+        new_nb.headers = self.headers.copy()
+        new_nb._last_execute = self._last_execute
+
+        await new_nb._create_notebook()
+        new_nb.session = self.session
+        new_nb.notebook["sessions"] = [self.session]
+        return new_nb
+
+    async def execute(self,
+                      sql: str,
+                      database: str = "default",
+                      print_log: bool = False,
+                      sync=True):
+        """
+        execute sql, its result is awaited if sync
+
+        :return: AsyncNotebookResult
+        """
+        sql_print = sql[: MAX_LEN_PRINT_SQL] + "..." \
+            if len(sql) > MAX_LEN_PRINT_SQL \
+            else sql
+        self.log.info(f"executing sql: {sql_print}")
+
+        snippet = build_snippet(sql, database, self.hive_settings)
+        notebook = {**self.notebook, "snippets": [snippet]}
+        r_json = await self._post("/notebook/api/execute/hive",
+                                  {"notebook": json.dumps(notebook),
+                                   "snippet": json.dumps(snippet)})
+        if r_json["status"] != 0:
+            self.log.error(r_json.get("message", r_json))
+            raise RuntimeError(r_json.get("message", r_json))
+
+        notebook["id"] = r_json.get('history_id', notebook.get("id", None))
+        notebook["uuid"] = r_json.get('history_uuid', notebook.get("uuid", None))
+        snippet["result"]["handle"] = r_json["handle"]
+
+        result = AsyncNotebookResult(self, QueryHandle(notebook, snippet))
+        if sync:
+            await result.await_result(print_log=print_log)
+        return result
+
+    async def close(self):
+        if self._client is None:
+            return
+
+        if self.is_logged_in and hasattr(self, "notebook"):
+            self.log.info(f"closing notebook")
+            try:
+                await self._post("/notebook/api/notebook/close/",
+                                 {"notebook": json.dumps(self.notebook)})
+            except Exception as e:
+                self.log.warning(e)
+
+        if self._owns_client:
+            await self._client.close()
+        self._client = None
+
+
+class AsyncNotebookResult(object):
+    """
+    Asyncio counterpart of hue.NotebookResult, mirrors check_status, await_result,
+    fetchall, iter_batches, to_frame and to_csv
+    """
+
+    def __init__(self, notebook: AsyncNotebook, handle: QueryHandle):
+        self.name = notebook.name
+        self.handle = handle
+        self.status = "running"
+        self.verbose = notebook.verbose
+
+        self.log = logging.getLogger(__name__ + f".AsyncNotebookResult[{self.name}]")
+        if self.verbose:
+            logger.set_stream_log_level(self.log, verbose=self.verbose)
+
+        self.data = None
+        self._notebook = notebook
+        self._log_lines = deque(maxlen=HUE_LOG_MAX_LINES)
+        self._job_log_lines = deque(maxlen=HUE_LOG_MAX_LINES)
+        self._tail_log_lines = deque(maxlen=HUE_LOG_TAIL_LINES)
+        self._logs_row = 0
+        self._last_check = None
+        self._app_ids = set()
+        self._app_id = ''
+        self._progress = 0.
+
+        self.rows_per_fetch = 32768
+        self.adaptive_fetch = HUE_FETCH_ADAPTIVE
+
+    def is_ready(self):
+        return self.status == "available"
+
+    @property
+    def full_log(self):
+        return "\n".join(self._log_lines)
+
+    def _payload(self, brief=True):
+        snippet = self.handle.snippet(self.status)
+        notebook = self.handle.notebook() if brief else self.handle.notebook(snippet)
+        return {"notebook": json.dumps(notebook), "snippet": json.dumps(snippet)}
+
+    async def fetch_cloud_logs(self):
+        self.log.debug("fetching cloud logs")
+        r_json = await self._notebook._post("/notebook/api/get_logs", {
+            **self._payload(),
+            "from": self._logs_row,
+            "jobs": [],
+            "full_log": "\n".join(chain(self._job_log_lines, self._tail_log_lines)),
+        })
+        if "logs" not in r_json:
+            if "message" in r_json:
+                self.log.warning(f"fetching_cloud_logs responses: {r_json['message']}")
+                return ''
+            raise RuntimeError(f"Could not parse logs from cloud response: {r_json}")
+
+        for job in r_json["jobs"]:
+            if job["started"] and not job["finished"]:
+                self._app_id = job["name"]
+            self._app_ids.add(job["name"])
+
+        self._progress = max(self._progress, r_json["progress"])
+        cloud_log = r_json["logs"]
+        if len(cloud_log) > 0:
+            lines = cloud_log.split("\n")
+            self._log_lines.extend(lines)
+            for line in lines:
+                if JOB_LOG_PATTERN.search(line):
+                    self._job_log_lines.append(line)
+                else:
+                    self._tail_log_lines.append(line)
+            self._logs_row += len(lines)
+
+        return cloud_log
+
+    async def check_status(self, return_log=False, update_interval=60.):
+        cur_check = time.perf_counter()
+        will_update_status = self._last_check is None \
+            or cur_check - self._last_check > update_interval
+
+        try:
+            cloud_log = await self.fetch_cloud_logs()
+        except RuntimeError:
+            cloud_log = ''
+
+        if "ERROR  :" in cloud_log:
+            will_update_status = True
+            self.log.error(cloud_log)
+        elif "INFO  : OK" in cloud_log:
+            will_update_status = True
+
+        if will_update_status:
+            self._last_check = cur_check
+            r_json = await self._notebook._post("/notebook/api/check_status", self._payload())
+            if r_json["status"] != 0:
+                raise RuntimeError(r_json.get("message", r_json))
+
+            self.status = r_json["query_status"]["status"]
+
+        if return_log:
+            return cloud_log
+        return self.status
+
+    async def await_result(self, wait_sec: float = None, print_log=False):
+        """
+        wait until result is available
+
+        :param wait_sec: seconds between polls, default to poll with adaptive intervals,
+                         see hue.poller.PollSchedule
+        :param print_log: whether to print cloud log during waiting
+        """
+        start_time = time.perf_counter()
+        schedule = PollSchedule()
+        interval = schedule.next_interval()
+        while True:
+            await asyncio.sleep(wait_sec if wait_sec is not None else interval)
+            cloud_log = await self.check_status(return_log=True)
+            if print_log and len(cloud_log) > 0:
+                print(cloud_log)
+
+            if self.is_ready():
+                self.log.debug(f"sql execution done in {time.perf_counter() - start_time:.2f} secs")
+                return
+            interval = schedule.next_interval(self._progress)
+
+    async def _iter_pages(self, rows: int = None):
+        """
+        asynchronous generator of raw result pages, like hue.NotebookResult._fetch_pages,
+        requests failed by proxy error or timeout are retried with fewer rows
+        """
+        controller = FetchSizeController(rows if isinstance(rows, int) else self.rows_per_fetch,
+                                         adaptive=self.adaptive_fetch and not isinstance(rows, int))
+        n_yielded, n_skip = 0, 0
+        start_over = True
+        while True:
+            start = time.perf_counter()
+            try:
+                content = await self._notebook._request(
+                    "POST", self._notebook.base_url + "/notebook/api/fetch_result_data/",
+                    data={**self._payload(brief=False),
+                          "rows": controller.rows,
+                          "startOver": "true" if start_over else "false"},
+                    timeout=aiohttp.ClientTimeout(total=HUE_FETCH_TIMEOUT_SECS),
+                    raise_on=(asyncio.TimeoutError,),
+                    fail_on_proxy_error=True)
+            except (asyncio.TimeoutError, RuntimeError) as e:
+                if isinstance(e, RuntimeError) and "proxy" not in str(e):
+                    raise
+                if not controller.shrink():
+                    raise
+
+                # the failed request might have moved server-side cursor forward,
+                # fetch from the start again and skip rows that were yielded
+                self.log.warning(f"fetching result failed, retry with {controller.rows} rows per fetch")
+                n_skip, start_over = n_yielded, True
+                continue
+
+            r_json = loads(content)
+            if r_json["status"] != 0:
+                raise RuntimeError(f"fetch_result_data responses status {r_json['status']}: "
+                                   f"{r_json.get('message', '')}")
+
+            page = r_json["result"]
+            controller.update(len(page["data"]), len(page["meta"]), len(content),
+                              time.perf_counter() - start)
+            start_over = False
+            if n_skip > 0:
+                n_dropped = min(n_skip, len(page["data"]))
+                del page["data"][: n_dropped]
+                n_skip -= n_dropped
+                if len(page["data"]) == 0 and page["has_more"]:
+                    continue
+
+            n_yielded += len(page["data"])
+            yield page
+
+            if not page["has_more"]:
+                return
+
+    async def iter_batches(self, rows_per_batch: int = None, typed=True):
+        """
+        asynchronous generator of pandas.DataFrame, one per fetched page
+
+        :param rows_per_batch: rows per fetch_result_data request, default adaptive
+        :param typed: default True, whether to build typed columns by hive column types
+        """
+        if not self.is_ready():
+            self.log.warning(f"result {self.status}")
+
+        normalizer = None
+        async for page in self._iter_pages(rows=rows_per_batch):
+            if normalizer is None:
+                normalizer = ColumnNormalizer(page["meta"])
+
+            yield normalizer.to_frame(page["data"], typed=typed)
+
+    async def to_frame(self, typed=True):
+        lst_df = [df async for df in self.iter_batches(typed=typed)]
+        if len(lst_df) == 1:
+            return lst_df[0]
+
+        return pd.concat(lst_df, ignore_index=True)
+
+    async def fetchall(self):
+        if not self.is_ready():
+            self.log.warning(f"result {self.status}")
+
+        lst_data, normalizer = [], None
+        async for page in self._iter_pages():
+            if normalizer is None:
+                normalizer = ColumnNormalizer(page["meta"])
+
+            lst_data.extend(normalizer.normalize_rows(page["data"]))
+
+        self.data = {"data": lst_data, "columns": normalizer.names}
+        return self.data
+
+    async def to_csv(self, file_name: str = None, encoding="utf-8", column_names: list = None):
+        """
+        download result of executed sql into a csv file
+
+        :param file_name: default notebook name
+        :param encoding: file encoding, default to utf-8
+        :param column_names: column names to rename to, default to original names
+        """
+        if file_name is None:
+            file_name = os.path.join(os.getcwd(), self.name + ".csv")
+
+        self.log.info(f"downloading to {file_name}")
+        with open(file_name, "w", newline="", encoding=encoding) as f:
+            i = 0
+            async for df in self.iter_batches():
+                if i == 0 and column_names:
+                    if len(df.columns) != len(column_names):
+                        self.log.warning(f"length of table columns({len(df.columns)}) "
+                                         f"mismatch with column_names({len(column_names)}), rename skipped")
+                    else:
+                        df.columns = column_names
+
+                df.to_csv(f, header=i == 0, index=False)
+                i += 1
+
+    async def close(self):
+        """
+        release result of executed sql on Hue, it can't be fetched afterward
+        """
+        r_json = await self._notebook._post("/notebook/api/close_statement", self._payload())
+        if r_json["status"] != 0:
+            self.log.warning(r_json.get("message", r_json))
+        self.status = "closed"
@@ -0,0 +1,330 @@
+import hashlib
+import importlib.util
+import json
+import logging
+import os
+import re
+import time
+import uuid
+
+import pandas as pd
+
+from .convert import widen_decimals, to_cells
+from .hue import NotebookResult
+from .. import logger
+from ..settings import HUE_CACHE_DIR, HUE_CACHE_TTL_SECS, HUE_CACHE_MAX_BYTES, PROGRESSBAR
+
+__all__ = ["ResultCache", "CachedResult"]
+
+# hive settings that only affect how a query runs, not its result, they are left out of cache key
+PERFORMANCE_SETTING_PATTERN = re.compile(
+    r"memory|java\.opts|priority|execution\.engine|input\.format|vectoriz|compress|parallel|sort\.mb"
+    r"|split|speculative|grouping|optimize|auto\.convert|mapjoin|skewjoin|cbo|reducer|prewarm|container"
+    r"|queue|recursive|subdirector|zerocopy|bucket|enforce\.sorting|dynamic\.partition")
+
+# queries that return rows, other statements are never cached
+QUERY_PATTERN = re.compile(r"^\s*(select|with)\b", re.IGNORECASE)
+
+
+def normalize_sql(sql: str):
+    """
+    strip comments, trailing semicolons and redundant whitespace outside quotes,
+    so that trivially different sqls share the same cache entry
+    """
+    tokens = re.findall(r"'(?:[^'\\]|\\.)*'|\"(?:[^\"\\]|\\.)*\"|`[^`]*`|--[^\n]*|\s+|[^'\"`\s-]+|-",
+                        sql)
+    normalized = []
+    for token in tokens:
+        if token.startswith("--"):
+            continue
+        if token.isspace():
+            if normalized and normalized[-1] != " ":
+                normalized.append(" ")
+            continue
+        normalized.append(token)
+
+    return "".join(normalized).strip().rstrip(";").strip()
+
+
+class ResultCache(object):
+    """
+    On-disk cache of query results in parquet, keyed by hash of normalized sql,
+    database and hive settings that may change the result.
+    Entries expire after ttl and least recently used entries are evicted
+    when total size exceeds max_bytes. Requires pyarrow.
+
+    Parameters:
+    cache_dir: str, default HUE_CACHE_DIR in settings
+        directory to store cached results
+    ttl: float, default HUE_CACHE_TTL_SECS in settings
+        seconds a cached result stays valid
+    max_bytes: int, default HUE_CACHE_MAX_BYTES in settings
+        maximum total size of cached results
+    verbose: bool, default False
+        whether to print log on stdout
+    """
+
+    def __init__(self,
+                 cache_dir: str = HUE_CACHE_DIR,
+                 ttl: float = HUE_CACHE_TTL_SECS,
+                 max_bytes: int = HUE_CACHE_MAX_BYTES,
+                 verbose: bool = False):
+        if not importlib.util.find_spec("pyarrow"):
+            raise ImportError("ResultCache requires pyarrow, please install it via pip")
+
+        self.cache_dir = os.path.abspath(os.path.expanduser(cache_dir))
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+
+        self.log = logging.getLogger(__name__ + ".ResultCache")
+        if verbose:
+            logger.set_stream_log_level(self.log, verbose=verbose)
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    @staticmethod
+    def is_cacheable(sql: str):
+        return QUERY_PATTERN.match(normalize_sql(sql)) is not None
+
+    def key(self, sql: str, database: str = "default", hive_settings: dict = None):
+        """
+        cache key of a query
+
+        :param sql: query string
+        :param database: database the query runs in
+        :param hive_settings: hive settings of notebook, those only affecting performance are ignored
+        """
+        settings = {k: str(v) for k, v in (hive_settings or {}).items()
+                    if not PERFORMANCE_SETTING_PATTERN.search(k)}
+        content = json.dumps([normalize_sql(sql), database, sorted(settings.items())])
+        return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+    def path(self, key: str):
+        return os.path.join(self.cache_dir, key + ".parquet")
+
+    def get(self, key: str):
+        """
+        :return: path of cached result, None if not cached or expired
+        """
+        path = self.path(key)
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            self.log.info(f"cache miss {key[:12]}")
+            return None
+
+        now = time.time()
+        if now - stat.st_mtime > self.ttl:
+            self.log.info(f"cache expired {key[:12]}")
+            self._remove(path)
+            return None
+
+        # access time is tracked explicitly for LRU, as file systems may not update it
+        os.utime(path, (now, stat.st_mtime))
+        self.log.info(f"cache hit {key[:12]}, {stat.st_size / 1024 ** 2:.1f} MB")
+        return path
+
+    def tee(self, key: str, batches, sql: str = ""):
+        """
+        write dataframes to cache while yielding them,
+        the entry is committed only if all batches are consumed
+
+        :param key: cache key
+        :param batches: iterable of pandas.DataFrame
+        :param sql: query string, stored in parquet metadata for invalidation by table
+        """
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        tmp_path = os.path.join(self.cache_dir, f".{key}.{uuid.uuid4().hex}.tmp")
+        writer, schema, failed = None, None, False
+        try:
+            for df in batches:
+                if not failed:
+                    try:
+                        table = pa.Table.from_pandas(df, preserve_index=False)
+                        if writer is None:
+                            # hive types are kept to format cells like Hue in CachedResult.fetchall
+                            hue_columns = json.dumps(df.attrs.get("hue_columns")).encode("utf-8")
+                            schema = widen_decimals(table.schema).with_metadata({**(table.schema.metadata or {}),
+                                                                 b"workflow4ds.sql": sql.encode("utf-8"),
+                                                                 b"workflow4ds.columns": hue_columns})
+                            writer = pq.ParquetWriter(tmp_path, schema)
+                        table = table.cast(schema)
+                        writer.write_table(table)
+                    except (pa.ArrowException, ValueError, TypeError) as e:
+                        self.log.warning(f"result {key[:12]} not cached: {e}")
+                        failed = True
+
+                yield df
+
+            if writer is not None:
+                writer.close()
+                writer = None
+                if not failed:
+                    self.put(key, tmp_path)
+        finally:
+            if writer is not None:
+                writer.close()
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def put(self, key: str, file_path: str):
+        """
+        move a parquet file into cache and evict least recently used entries if cache is full
+        """
+        path = self.path(key)
+        os.replace(file_path, path)
+        self.log.info(f"cached {key[:12]}, {os.path.getsize(path) / 1024 ** 2:.1f} MB")
+        self._evict()
+        return path
+
+    def invalidate(self, sql: str = None, database: str = "default", hive_settings: dict = None,
+                   key: str = None, table: str = None):
+        """
+        remove cached results of a query, of a key, or of all queries reading a table
+
+        :return: number of removed entries
+        """
+        import pyarrow.parquet as pq
+
+        if sql is not None:
+            key = self.key(sql, database, hive_settings)
+
+        if key is not None:
+            n_removed = int(self._remove(self.path(key)))
+        elif table is not None:
+            pattern = re.compile(r"\b" + re.escape(table.lower()) + r"\b")
+            n_removed = 0
+            for path in self._entries():
+                metadata = pq.read_schema(path).metadata or {}
+                cached_sql = metadata.get(b"workflow4ds.sql", b"").decode("utf-8")
+                if pattern.search(cached_sql.lower()):
+                    n_removed += self._remove(path)
+        else:
+            raise ValueError("please provide either sql, key or table to invalidate")
+
+        self.log.info(f"invalidated {n_removed} cached results")
+        return n_removed
+
+    def clear(self):
+        n_removed = sum(self._remove(path) for path in self._entries())
+        self.log.info(f"cleared {n_removed} cached results")
+        return n_removed
+
+    def _entries(self):
+        return [os.path.join(self.cache_dir, file_name)
+                for file_name in os.listdir(self.cache_dir)
+                if file_name.endswith(".parquet")]
+
+    def _remove(self, path: str):
+        try:
+            os.remove(path)
+            return True
+        except FileNotFoundError:
+            return False
+
+    def _evict(self):
+        entries = []
+        for path in self._entries():
+            try:
+                entries.append((os.stat(path), path))
+            except FileNotFoundError:
+                continue
+
+        total = sum(stat.st_size for stat, _ in entries)
+        # least recently used first
+        for stat, path in sorted(entries, key=lambda entry: entry[0].st_atime):
+            if total <= self.max_bytes:
+                break
+
+            self.log.info(f"evicting cached {os.path.basename(path)[:12]}")
+            self._remove(path)
+            total -= stat.st_size
+
+
+class CachedResult(NotebookResult):
+    """
+    Result of a query read from ResultCache,
+    it serves the same fetching and saving methods as NotebookResult
+    """
+
+    def __init__(self, path: str, name: str = "", verbose: bool = False):
+        self.path = path
+        self.name = name
+        self.status = "available"
+        self.verbose = verbose
+        self.data = None
+
+        self.log = logging.getLogger(__name__ + f".CachedResult[{self.name}]")
+        if self.verbose:
+            logger.set_stream_log_level(self.log, verbose=self.verbose)
+
+        self._progress = 100.
+        self._progressbar = None
+        self._progressbar_format = PROGRESSBAR.copy()
+        self._progressbar_format["desc"] = PROGRESSBAR["desc"].format(name=self.name, result="result")
+        self._cache = None
+
+    def check_status(self, return_log=False, update_interval=60.):
+        return '' if return_log else self.status
+
+    def await_result(self, *args, **kwargs):
+        return
+
+    def close(self):
+        return
+
+    def fetch_result_size(self):
+        import pyarrow.parquet as pq
+
+        metadata = pq.read_metadata(self.path)
+        return metadata.num_rows, metadata.serialized_size
+
+    def _iter_batches(self, rows_per_batch=None, typed=True, progressbar=False, total=None, progressbar_offset=0):
+        import pyarrow.parquet as pq
+
+        parquet_file = pq.ParquetFile(self.path)
+        metadata = parquet_file.schema_arrow.metadata or {}
+        hue_columns = json.loads(metadata.get(b"workflow4ds.columns", b"null"))
+        pbar = self._setup_progressbar(parquet_file.metadata.num_rows, progressbar_offset) \
+            if progressbar else None
+        try:
+            if rows_per_batch is None:
+                batches = (parquet_file.read_row_group(i) for i in range(parquet_file.num_row_groups))
+            else:
+                batches = parquet_file.iter_batches(batch_size=rows_per_batch)
+
+            for batch in batches:
+                df = batch.to_pandas()
+                if not typed and hue_columns is not None:
+                    # cells as Hue returns them, formatted by hive type, NULL as ''
+                    df = pd.DataFrame({j: to_cells(df.iloc[:, j], type_, cell_type, scale)
+                                       for j, (type_, cell_type, scale) in enumerate(zip(hue_columns["types"],
+                                                                                         hue_columns["cell_types"],
+                                                                                         hue_columns["scales"]))},
+                                      dtype=object)
+                    df.columns = parquet_file.schema_arrow.names
+                elif not typed:
+                    # cached by an earlier version without hive types
+                    for column in df.columns[[dtype.kind == "M" for dtype in df.dtypes]]:
+                        df[column] = df[column].dt.strftime("%Y-%m-%d %H:%M:%S")
+                    df = df.astype(object).where(df.notna(), '')
+                if pbar is not None:
+                    pbar.update(len(df))
+
+                yield df
+        finally:
+            if pbar is not None:
+                pbar.close()
+
+    def fetchall(self, progressbar=True, total=None, progressbar_offset=0):
+        df = self.to_frame(typed=False, progressbar=progressbar)
+        self.data = {"data": df.values.tolist(), "columns": list(df.columns)}
+        return self.data
+
+    def download(self, file_name: str = None, format: str = "csv", encoding="utf-8", column_names: list = None,
+                 total: int = None, fallback=True, progressbar=True, progressbar_offset=0):
+        abs_path = self._prepare_path(file_name, suffixes=("csv",) if format == "csv" else ("xlsx", "xls"))
+        return self._download_by_pages(abs_path, format, encoding, column_names, total,
+                                       progressbar, progressbar_offset)
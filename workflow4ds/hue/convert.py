@@ -0,0 +1,381 @@
+import importlib.util
+import json
+import logging
+from decimal import Decimal, InvalidOperation
+from html import unescape
+from unicodedata import normalize
+
+import numpy as np
+import pandas as pd
+
+from ..settings import HUE_NORMALIZE_MEMO_SIZE, HUE_JSON_BACKEND
+
+# faster json backends are used if installed
+if importlib.util.find_spec("ijson"):
+    import ijson
+else:
+    ijson = None
+
+if importlib.util.find_spec("orjson"):
+    import orjson
+else:
+    orjson = None
+
+__all__ = ["ColumnNormalizer", "column_type", "decode_response", "loads", "widen_decimals", "to_cells",
+           "HIVE_DTYPES"]
+
+NUMERIC_TYPES = {"tinyint", "smallint", "int", "integer", "bigint",
+                 "float", "double", "decimal"}
+
+# pandas dtypes of hive column types, columns of other types are kept as python objects.
+# decimal is kept exact as decimal.Decimal objects, timestamps are parsed in microseconds
+# so that dates like 9999-12-31 fit in
+HIVE_DTYPES = {
+    "tinyint": "Int8",
+    "smallint": "Int16",
+    "int": "Int32",
+    "integer": "Int32",
+    "bigint": "Int64",
+    "float": "float32",
+    "double": "float64",
+    "decimal": "object",
+    "boolean": "boolean",
+    "timestamp": "datetime64[us]",
+    "date": "datetime64[us]",
+}
+
+
+def column_type(meta: dict):
+    """
+    Hue reports hive column types like "BIGINT_TYPE" or "decimal(10,2)",
+    reduce them to plain lower case hive type names like "bigint" or "decimal"
+    """
+    type_ = meta.get("type", "") or ""
+    type_ = type_.lower().partition("(")[0].strip()
+    if type_.endswith("_type"):
+        type_ = type_[: -len("_type")]
+    return type_
+
+
+class _CountingReader(object):
+    def __init__(self, raw):
+        self.raw = raw
+        self.n_bytes = 0
+
+    def read(self, size=-1):
+        chunk = self.raw.read(size)
+        self.n_bytes += len(chunk)
+        return chunk
+
+
+def decode_response(res, backend: str = HUE_JSON_BACKEND):
+    """
+    decode json body of a streamed response.
+    orjson decodes the whole body fastest, ijson parses the body incrementally from the socket,
+    so that it never exists as both raw bytes and python objects, at the cost of speed
+
+    :param res: requests.Response requested with stream=True
+    :param backend: "orjson", "ijson" or "json", default HUE_JSON_BACKEND in settings,
+                    None for orjson if installed, then ijson, then json
+    :return: tuple of decoded object and number of body bytes
+    """
+    if backend is None:
+        backend = "orjson" if orjson is not None else "ijson" if ijson is not None else "json"
+    if backend not in ("orjson", "ijson", "json"):
+        raise ValueError(f"unknown json backend '{backend}', use 'orjson', 'ijson' or 'json'")
+    if backend == "ijson" and ijson is None:
+        raise ImportError("json backend 'ijson' is not installed")
+
+    if backend == "ijson" and not res._content_consumed:
+        # let urllib3 take care of gzip, deflate etc.
+        res.raw.decode_content = True
+        reader = _CountingReader(res.raw)
+        r_json = next(ijson.items(reader, "", use_float=True))
+        res.close()
+        return r_json, reader.n_bytes
+
+    content = res.content
+    if backend == "json":
+        return json.loads(content), len(content)
+    return loads(content), len(content)
+
+
+def loads(content: bytes):
+    """
+    decode json body with orjson if installed, otherwise with json
+    """
+    if orjson is not None:
+        try:
+            return orjson.loads(content)
+        except orjson.JSONDecodeError:
+            # orjson is strict on e.g. NaN, leave it to json
+            pass
+
+    return json.loads(content)
+
+
+def widen_decimals(schema):
+    """
+    widen decimal fields of an arrow schema to the maximum precision of hive,
+    so that later pages with more digits can be cast to the schema of the first page
+    """
+    import pyarrow as pa
+
+    for i, field in enumerate(schema):
+        if pa.types.is_decimal(field.type):
+            schema = schema.set(i, field.with_type(pa.decimal128(38, field.type.scale)))
+    return schema
+
+
+def _to_array(col, dtype: str):
+    """
+    convert a column of a result page to typed array, "NULL" becomes missing value.
+    cells that don't parse raise ValueError instead of being coerced to missing values
+    """
+    if "NULL" in col or '' in col:
+        col = [None if s == "NULL" or s == '' else s for s in col]
+
+    if dtype.startswith("datetime64"):
+        return np.array(col, dtype=dtype)
+
+    if dtype == "object":
+        # decimal
+        try:
+            return np.array([None if s is None else Decimal(str(s)) for s in col], dtype=object)
+        except InvalidOperation:
+            raise ValueError(f"invalid decimal in {[s for s in col if s is not None][:3]}")
+
+    try:
+        if dtype.startswith("float"):
+            return np.asarray(col, dtype=dtype)
+        return pd.array(col, dtype=dtype)
+    except (TypeError, ValueError):
+        pass
+
+    # cells came as strings, e.g. decimal or "true"/"false"
+    series = pd.Series(col, dtype=object)
+    if dtype == "boolean":
+        return series.map({"true": True, "false": False, True: True, False: False}).astype(dtype).array
+    return pd.to_numeric(series).astype(dtype).array
+
+
+def _format_timestamp(value):
+    # hive prints fraction of seconds without trailing zeros
+    text = value.strftime("%Y-%m-%d %H:%M:%S")
+    fraction = f"{value.microsecond:06d}{getattr(value, 'nanosecond', 0):03d}".rstrip("0")
+    return text + "." + fraction if fraction else text
+
+
+def _format_float(value, type_: str):
+    # shortest representation that reads back to the same value of column precision
+    return str(np.float32(value)) if type_ == "float" else repr(float(value))
+
+
+def _format_decimal(value, scale: int = None):
+    # decimals are padded to the scale Hue printed, but never rounded to it
+    value = value.normalize()
+    if scale is not None and -value.as_tuple().exponent < scale:
+        value = value.quantize(Decimal(1).scaleb(-scale))
+    return format(value, "f")
+
+
+def to_cells(col, type_: str, cell_type: str = None, scale: int = None):
+    """
+    format a typed column back to cells as Hue returns them in fetch_result_data,
+    missing values become '' like normalized "NULL"
+
+    :param col: pandas.Series built by ColumnNormalizer.to_frame
+    :param type_: hive type of column, see column_type
+    :param cell_type: python type name of cells Hue returned, e.g. "str" or "float",
+                      default to str for all but integer, float and double columns
+    :param scale: digits after decimal point of decimal cells Hue returned
+    :return: list of cells
+    """
+    if cell_type is None:
+        cell_type = "int" if type_ in ("tinyint", "smallint", "int", "integer", "bigint") \
+            else "float" if type_ in ("float", "double") \
+            else "str"
+
+    if type_ == "date":
+        fmt = lambda v: v.strftime("%Y-%m-%d")
+    elif type_ == "timestamp":
+        fmt = _format_timestamp
+    elif type_ in ("float", "double"):
+        fmt = (lambda v: _format_float(v, type_)) if cell_type == "str" \
+            else (lambda v: float(_format_float(v, type_)))
+    elif type_ == "boolean":
+        fmt = (lambda v: "true" if v else "false") if cell_type == "str" else bool
+    elif type_ == "decimal":
+        fmt = lambda v: _format_decimal(v, scale)
+    elif type_ in NUMERIC_TYPES:
+        fmt = str if cell_type == "str" else int
+    else:
+        fmt = None
+
+    return ['' if v is None or v is pd.NA or v is pd.NaT or (isinstance(v, float) and np.isnan(v))
+            else v if fmt is None or isinstance(v, str)
+            else fmt(v)
+            for v in col.astype(object)]
+
+
+def _normalize_cell(s):
+    if s.__class__ is not str:
+        return s
+    if s == "NULL":
+        return ''
+    return normalize("NFKC", unescape(s))
+
+
+class ColumnNormalizer(object):
+    """
+    Column-wise normalizer for cells of Hue result pages
+
+    Parameters:
+    meta: list of dict
+        "meta" of fetch_result_data response, used to skip numeric columns
+        and to type columns in to_frame
+    memo_size: int, default HUE_NORMALIZE_MEMO_SIZE in settings
+        maximum number of normalized values remembered per column,
+        memoization only applies to low-cardinality columns
+    """
+
+    def __init__(self, meta: list, memo_size: int = HUE_NORMALIZE_MEMO_SIZE):
+        self.names = [m["name"].rpartition(".")[2] for m in meta]
+        self.types = [column_type(m) for m in meta]
+        self.memo_size = memo_size
+        self._memos = [{} for _ in meta]
+        # columns that failed to convert to their hive type, kept as strings from then on
+        self._untyped = set()
+        # python type names of cells Hue returns per column, e.g. numbers might come as str or float
+        self.cell_types = [None] * len(meta)
+        # digits after decimal point of decimal columns, None if they vary
+        self.scales = [None] * len(meta)
+
+        self.log = logging.getLogger(__name__ + ".ColumnNormalizer")
+
+    def normalize_columns(self, rows: list):
+        """
+        transpose rows of a page into columns and normalize every column
+
+        :param rows: "data" of fetch_result_data response
+        :return: list of columns, each column is a list of cells
+        """
+        if len(rows) == 0:
+            return [[] for _ in self.types]
+
+        lst_columns = []
+        for col, type_, memo in zip(zip(*rows), self.types, self._memos):
+            normalized = self._normalize_column(col, type_, memo)
+            lst_columns.append(list(col) if normalized is None else normalized)
+
+        return lst_columns
+
+    def normalize_rows(self, rows: list):
+        """
+        normalize a page in place and keep its row orientation,
+        only columns that actually change are written back to rows
+
+        :param rows: "data" of fetch_result_data response
+        :return: rows
+        """
+        if len(rows) == 0:
+            return rows
+
+        for j, (col, type_, memo) in enumerate(zip(zip(*rows), self.types, self._memos)):
+            normalized = self._normalize_column(col, type_, memo)
+            if normalized is None:
+                continue
+
+            for row, val in zip(rows, normalized):
+                row[j] = val
+
+        return rows
+
+    def to_frame(self, rows: list, typed: bool = True):
+        """
+        build pandas.DataFrame from a page column by column
+
+        :param rows: "data" of fetch_result_data response
+        :param typed: default True, whether to build columns of types in HIVE_DTYPES
+                      as typed arrays, otherwise all columns are kept as python objects
+        :return: pandas.DataFrame
+        """
+        columns = zip(*rows) if len(rows) else [()] * len(self.types)
+        data = {}
+        for j, (col, type_, memo) in enumerate(zip(columns, self.types, self._memos)):
+            dtype = HIVE_DTYPES.get(type_) if typed and j not in self._untyped else None
+            if dtype is not None:
+                if self.cell_types[j] is None:
+                    cell = next((s for s in col if s is not None and s != "NULL" and s != ''), None)
+                    self.cell_types[j] = None if cell is None else type(cell).__name__
+
+                try:
+                    data[j] = _to_array(col, dtype)
+                    if type_ == "decimal" and self.scales[j] is None:
+                        scales = {-v.as_tuple().exponent for v in data[j] if v is not None}
+                        self.scales[j] = scales.pop() if len(scales) == 1 else None
+                    continue
+                except (TypeError, ValueError, OverflowError) as e:
+                    # cells are never coerced to missing values, the column is kept as strings instead
+                    self.log.warning(f"cannot convert column '{self.names[j]}' to {type_}: {e}, "
+                                     f"it is kept as strings from this page on")
+                    self._untyped.add(j)
+
+            normalized = self._normalize_column(col, type_, memo)
+            if len(col) == 0:
+                data[j] = np.empty(0, dtype=object)
+            else:
+                data[j] = list(col) if normalized is None else normalized
+
+        df = pd.DataFrame(data)
+        df.columns = self.names
+        # lets typed columns be formatted back to cells, see to_cells
+        df.attrs["hue_columns"] = {"types": self.types, "cell_types": list(self.cell_types),
+                                   "scales": list(self.scales)}
+        return df
+
+    def _normalize_column(self, col: tuple, type_: str, memo: dict):
+        """
+        return normalized column as list, or None if the column needs no change
+        """
+        # numeric columns hold no html entity or full-width character
+        if type_ in NUMERIC_TYPES:
+            if "NULL" not in col:
+                return None
+            return ['' if s == "NULL" else s for s in col]
+
+        # fast path: pure ascii strings without "&" are already normalized
+        try:
+            joined = "".join(col)
+        except TypeError:
+            joined = None
+        if joined is not None and joined.isascii() and "&" not in joined:
+            if "NULL" not in col:
+                return None
+            return ['' if s == "NULL" else s for s in col]
+        del joined
+
+        # estimate cardinality on a sample before hashing the whole column
+        try:
+            is_low_cardinality = len(set(col[: 1024])) * 2 <= min(len(col), 1024)
+            uniques = set(col) if is_low_cardinality else None
+        except TypeError:
+            uniques = None
+
+        # low-cardinality column: normalize each distinct value only once
+        if uniques is not None:
+            mapping = {}
+            for s in uniques:
+                val = memo.get(s, memo)
+                if val is memo:
+                    val = _normalize_cell(s)
+                    if len(memo) < self.memo_size:
+                        memo[s] = val
+                mapping[s] = val
+            return list(map(mapping.__getitem__, col))
+
+        return ['' if s == "NULL"
+                else normalize("NFKC", unescape(s))
+                if s.__class__ is str and ("&" in s or not s.isascii())
+                else s
+                for s in col]
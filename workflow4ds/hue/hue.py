@@ -1,24 +1,84 @@
-import copy
-import gc
+import codecs
 import csv
+import io
 import json
+import re
 from tqdm import tqdm
 import logging
 import os
+import queue
+import threading
 import time
 import traceback
 import uuid
+from collections import deque
+from itertools import chain
 import getpass
 from datetime import datetime
-from html import unescape
-from unicodedata import normalize
 import requests
+import pandas as pd
 
+from .convert import ColumnNormalizer, decode_response, widen_decimals
+from .poller import PollSchedule
 from .. import logger
-from ..settings import HUE_BASE_URL, MAX_LEN_PRINT_SQL, HIVE_PERFORMANCE_SETTINGS, PROGRESSBAR, HUE_INACTIVE_TIME
+from ..settings import HUE_BASE_URL, MAX_LEN_PRINT_SQL, HIVE_PERFORMANCE_SETTINGS, PROGRESSBAR, HUE_INACTIVE_TIME, \
+    HUE_RESULT_PREFETCH_PAGES, HUE_FETCH_ADAPTIVE, HUE_FETCH_MIN_ROWS, HUE_FETCH_MAX_ROWS, \
+    HUE_FETCH_TARGET_BYTES, HUE_FETCH_TARGET_SECS, HUE_FETCH_TIMEOUT_SECS, HUE_LOG_MAX_LINES, HUE_LOG_TAIL_LINES, \
+    HUE_EXPORT_CHUNK_SIZE, HUE_EXPORT_MAX_ROWS, EXCEL_ENGINE
 from ..decorators import retry, ensure_login
 
-__all__ = ["Notebook", "Beeswax"]
+__all__ = ["Notebook", "Beeswax", "QueryHandle"]
+
+# log lines Hue parses jobs and MapReduce progress from, these are always sent back to get_logs
+JOB_LOG_PATTERN = re.compile(r"application_\d+_\d+|job_\d+_\d+|Total jobs = \d+|Ended Job")
+
+
+def build_snippet(sql: str, database: str = "default", hive_settings: dict = None):
+    """
+    build a new hive snippet posted to notebook execute api
+
+    :param sql: statements to execute, separated by ';'
+    :param database: database on Hive
+    :param hive_settings: hive settings of the snippet
+    """
+    statements_list = sql.split(";")
+    timestamp = datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S:%f")[:-3] + "Z"
+    hive_settings = {} if hive_settings is None else hive_settings
+    return {
+        "id": str(uuid.uuid4()),
+        "type": "hive",
+        "status": "running",
+        "statementType": "text",
+        "statement": sql,
+        "statement_raw": sql,
+        "statementsList": statements_list,
+        "statementPath": "",
+        "associatedDocumentUuid": None,
+        "properties": {
+            "settings": [{"key": k, "value": v} for k, v in hive_settings.items()],
+            "files": [],
+            "functions": [],
+            "arguments": []},
+        "result": {
+            "id": str(uuid.uuid4()),
+            "type": "table",
+            "handle": {
+                "has_more_statements": len(statements_list) > 1,
+                "statement_id": 0,
+                "statements_count": len(statements_list),
+                "previous_statement_hash": None
+                },
+            "statement_id": 0,
+            "statements_count": len(statements_list),
+            "fetchedOnce": False,
+            "startTime": timestamp,
+            "endTime": timestamp,
+            "executionTime": 0,
+            },
+        "database": database,
+        "lastExecuted": int(datetime.now().timestamp() * 10 ** 3),
+        "wasBatchExecuted": False
+        }
 
 
 class Beeswax(requests.Session):
@@ -404,41 +464,7 @@ class Notebook(requests.Session):
             self.snippet["lastExecuted"] = int(datetime.now().timestamp() * 10 ** 3)
             self.snippet["status"] = "running"
         else:
-            self.snippet = {
-                "id": str(uuid.uuid4()),
-                "type": "hive",
-                "status": "running",
-                "statementType": "text",
-                "statement": sql,
-                "statement_raw": sql,
-                "statementsList": statements_list,
-                "statementPath": "",
-                "associatedDocumentUuid": None,
-                "properties": {
-                    "settings": [{"key": k, "value": v} for k, v in self.hive_settings.items()],
-                    "files": [],
-                    "functions": [],
-                    "arguments": []},
-                "result": {
-                    "id": str(uuid.uuid4()),
-                    "type": "table",
-                    "handle": {
-                        "has_more_statements": len(statements_list) > 1,
-                        "statement_id": 0,
-                        "statements_count": len(statements_list),
-                        "previous_statement_hash": None
-                        },
-                    "statement_id": 0,
-                    "statements_count": len(statements_list),
-                    "fetchedOnce": False,
-                    "startTime": timestamp,
-                    "endTime": timestamp,
-                    "executionTime": 0,
-                    },
-                "database": database,
-                "lastExecuted": int(datetime.now().timestamp() * 10 ** 3),
-                "wasBatchExecuted": False
-                }
+            self.snippet = build_snippet(sql, database, self.hive_settings)
 
     @ensure_login
     def execute(self,
@@ -653,21 +679,20 @@ class Notebook(requests.Session):
                      hive_settings=None,
                      recreate_session=False,
                      verbose: bool = None):
-        new_nb = copy.deepcopy(self)
+        # do not log in again, the new notebook shares connection pool and login state
+        new_nb = Notebook(name=name,
+                          description=description,
+                          base_url=self.base_url,
+                          hive_settings=hive_settings,
+                          verbose=self.verbose if verbose is None else verbose)
+        for prefix, adapter in self.adapters.items():
+            new_nb.mount(prefix, adapter)
+        new_nb.cookies = self.cookies.copy()
+        new_nb.headers = self.headers.copy()
 
-        new_nb.username = self.username
-        new_nb.name = name
-        new_nb.description = description
-        new_nb.base_url = self.base_url
-        new_nb.hive_settings = hive_settings
         new_nb.username = self.username
         new_nb._password = self._password
         new_nb._last_execute = self._last_execute
-        new_nb.verbose = self.verbose if verbose is None else verbose
-
-        new_nb.log = logging.getLogger(__name__ + f".Notebook[{name}]")
-        if new_nb.verbose:
-            logger.set_stream_log_level(new_nb.log, verbose=new_nb.verbose)
 
         if recreate_session:
             new_nb._prepare_notebook(name, description,
@@ -719,6 +744,168 @@ class Notebook(requests.Session):
         self.logout()
 
 
+class FetchSizeController(object):
+    """
+    Adaptive controller of rows per fetch_result_data request
+
+    Rows per request grows while response bytes and latency of a full page
+    stay under targets, and is cut at once when a request fails.
+    Best size is remembered by number of columns and shared by all results,
+    so that later queries of similar width start near the optimum.
+
+    Parameters:
+    rows: int
+        initial rows per request
+    adaptive: bool, default True
+        if False, rows per request is kept fixed
+    """
+
+    # best known rows per fetch by number of columns
+    best_rows = {}
+
+    def __init__(self,
+                 rows: int,
+                 adaptive: bool = True,
+                 min_rows: int = HUE_FETCH_MIN_ROWS,
+                 max_rows: int = HUE_FETCH_MAX_ROWS,
+                 target_bytes: int = HUE_FETCH_TARGET_BYTES,
+                 target_secs: float = HUE_FETCH_TARGET_SECS):
+        self.rows = rows
+        self.adaptive = adaptive
+        self.min_rows = min_rows
+        self.max_rows = max_rows
+        self.target_bytes = target_bytes
+        self.target_secs = target_secs
+        self.n_columns = None
+        # rows per request is kept below the size that once failed
+        self._ceiling = max_rows
+
+    def update(self, n_rows: int, n_columns: int, n_bytes: int, secs: float):
+        if not self.adaptive:
+            return
+
+        if self.n_columns is None:
+            self.n_columns = n_columns
+            if n_columns in self.best_rows:
+                # jump to remembered size after the first page
+                self.rows = self.best_rows[n_columns]
+                return
+
+        # a partial page is the last one, and its latency is dominated by overhead
+        if n_rows == 0 or n_rows < self.rows:
+            return
+
+        ideal_rows = min(self.target_bytes * n_rows / max(n_bytes, 1),
+                         self.target_secs * n_rows / max(secs, 1e-3))
+        rows = max(self.rows // 2, min(int(ideal_rows), self.rows * 2))
+        self.rows = max(self.min_rows, min(rows, self._ceiling))
+        self.best_rows[n_columns] = self.rows
+
+    def shrink(self):
+        """
+        cut down rows per request after a failure
+
+        :return: False if rows per request can't be smaller
+        """
+        if self.rows <= self.min_rows:
+            return False
+
+        self._ceiling = max(self.min_rows, self.rows // 2)
+        self.rows = max(self.min_rows, self.rows // 4)
+        self.adaptive = True
+        if self.n_columns is not None:
+            self.best_rows[self.n_columns] = self.rows
+        return True
+
+
+class QueryHandle(object):
+    """
+    Immutable handle of an executed statement, it holds only the notebook and
+    snippet fields Hue result apis (check_status, fetch_result_data, get_logs etc.) read,
+    so that results don't need to copy the whole notebook and snippet of their Notebook,
+    which are mutated in place by the next execution
+
+    Parameters:
+    notebook: dict, Notebook.notebook at the time of execution
+    snippet: dict, Notebook.snippet at the time of execution
+    """
+
+    __slots__ = ("notebook_id", "notebook_uuid", "notebook_type", "notebook_name", "is_saved",
+                 "sessions", "snippet_id", "snippet_type", "statement", "database",
+                 "settings", "result_id", "handle")
+
+    def __init__(self, notebook: dict, snippet: dict):
+        set_ = super(QueryHandle, self).__setattr__
+        set_("notebook_id", notebook.get("id"))
+        set_("notebook_uuid", notebook["uuid"])
+        set_("notebook_type", notebook["type"])
+        set_("notebook_name", notebook.get("name", ""))
+        set_("is_saved", notebook.get("isSaved", False))
+        # session dicts and settings list are replaced rather than mutated by Notebook
+        set_("sessions", tuple(notebook["sessions"]))
+        set_("snippet_id", snippet["id"])
+        set_("snippet_type", snippet["type"])
+        set_("statement", snippet["statement"])
+        set_("database", snippet["database"])
+        set_("settings", snippet["properties"]["settings"])
+        set_("result_id", snippet["result"]["id"])
+        # handle is updated in place when preparing the next snippet
+        set_("handle", dict(snippet["result"]["handle"]))
+
+    def __setattr__(self, key, value):
+        raise AttributeError(f"{self.__class__.__name__} is immutable")
+
+    def __delattr__(self, key):
+        raise AttributeError(f"{self.__class__.__name__} is immutable")
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}(guid={self.handle.get('guid')}, " \
+               f"statement_id={self.handle.get('statement_id')})"
+
+    def snippet(self, status: str):
+        """
+        build snippet posted to result apis
+
+        :param status: current status of the statement
+        """
+        return {
+            "id": self.snippet_id,
+            "type": self.snippet_type,
+            "status": status,
+            "statementType": "text",
+            "statement": self.statement,
+            "statement_raw": self.statement,
+            "database": self.database,
+            "properties": {"settings": self.settings},
+            "result": {
+                "id": self.result_id,
+                "type": "table",
+                "handle": self.handle,
+                "statement_id": self.handle.get("statement_id", 0),
+                "statements_count": self.handle.get("statements_count", 1),
+            },
+        }
+
+    def notebook(self, snippet: dict = None):
+        """
+        build notebook posted to result apis
+
+        :param snippet: if given, the notebook is built with it as the only snippet
+        """
+        notebook = {
+            "id": self.notebook_id,
+            "uuid": self.notebook_uuid,
+            "parentSavedQueryUuid": None,
+            "isSaved": self.is_saved,
+            "sessions": list(self.sessions),
+            "type": self.notebook_type,
+            "name": self.notebook_name,
+        }
+        if snippet is not None:
+            notebook["snippets"] = [snippet]
+        return notebook
+
+
 class NotebookResult(object):
     """
     An integrated class to interact with executed sql result
@@ -727,8 +914,8 @@ class NotebookResult(object):
     def __init__(self, notebook):
         self.name = notebook.name
         self.base_url = notebook.base_url
-        self.notebook = copy.deepcopy(notebook.notebook)
-        self.snippet = copy.deepcopy(notebook.snippet)
+        self.handle = QueryHandle(notebook.notebook, notebook.snippet)
+        self.status = notebook.snippet["status"]
         self.is_logged_in = notebook.is_logged_in
         self.verbose = notebook.verbose
 
@@ -739,7 +926,15 @@ class NotebookResult(object):
         self._progressbar_format = PROGRESSBAR.copy()
         self._progressbar_format["desc"] = PROGRESSBAR["desc"].format(name=self.name, result="result")
         self.data = None
-        self.full_log = ""
+        # only the latest HUE_LOG_MAX_LINES lines of log are kept
+        self._log_lines = deque(maxlen=HUE_LOG_MAX_LINES)
+        # what is sent back to Hue: job related lines and the latest other lines
+        self._job_log_lines = deque(maxlen=HUE_LOG_MAX_LINES)
+        self._tail_log_lines = deque(maxlen=HUE_LOG_TAIL_LINES)
+        self._n_log_polls = 0
+        self._log_bytes_sent = 0
+        self._n_polls = 0
+        self._n_requests = {"check_status": 0, "get_logs": 0, "jobbrowser": 0}
         self._last_check = None
         self._logs_row = 0
         self._app_ids = set()
@@ -749,38 +944,108 @@ class NotebookResult(object):
         self._progressor = self._progress_updater()
 
         self._notebook = notebook
+        self._payload_cache = (None, {})
+        # (ResultCache, key) if result is to be cached when iterated, see hue.cache
+        self._cache = None
+        # whether all rows have been fetched, and whether to close statement then
+        self._consumed = False
+        self._close_when_consumed = False
+        self._close_lock = threading.Lock()
         # the proxy might fail to respond when the response body becomes too large
         # manually set it smaller if so
         self.rows_per_fetch = 32768
+        # adapt rows per fetch to response size and latency of each page
+        self.adaptive_fetch = HUE_FETCH_ADAPTIVE
+        # pages fetched ahead by a background thread while the current page is consumed
+        # set it to 0 to fetch pages in the consuming thread
+        self.prefetch_pages = HUE_RESULT_PREFETCH_PAGES
+
+    @property
+    def snippet(self):
+        return self.handle.snippet(self.status)
+
+    @property
+    def notebook(self):
+        return self.handle.notebook(self.snippet)
 
     def is_ready(self):
-        return self.snippet["status"] == "available"
+        return self.status == "available"
+
+    def _payload(self, brief=True):
+        """
+        serialized notebook and snippet posted to status and result apis,
+        the handle is immutable so they are cached until status changes
+
+        :param brief: whether to post the notebook without snippets,
+                      fetch_result_data is posted with snippets of notebook
+        """
+        cached_status, cache = self._payload_cache
+        if self.status != cached_status:
+            snippet = self.handle.snippet(self.status)
+            cache = {"snippet": json.dumps(snippet),
+                     "brief_notebook": json.dumps(self.handle.notebook()),
+                     "notebook": json.dumps(self.handle.notebook(snippet))}
+            # replace status and cache at once, pages may be prefetched by another thread
+            self._payload_cache = (self.status, cache)
+
+        return {"notebook": cache["brief_notebook" if brief else "notebook"],
+                "snippet": cache["snippet"]}
+
+    @retry(__name__)
+    def _close_statement(self):
+        url = self.base_url + "/notebook/api/close_statement"
+        res = self._notebook.post(url, data=self._payload())
+        return res
+
+    def close(self):
+        """
+        Release result of executed sql on Hue, it can't be fetched afterward
+        """
+        self.log.debug(f"closing statement")
+        r_json = self._close_statement().json()
+        if r_json["status"] != 0:
+            self.log.warning(r_json.get("message", r_json))
+        self.status = "closed"
+
+    def close_when_consumed(self):
+        """
+        Release result on Hue right away if all rows have been fetched,
+        otherwise as soon as the last page is fetched
+        """
+        with self._close_lock:
+            self._close_when_consumed = True
+            consumed = self._consumed
+
+        if consumed and self.status != "closed":
+            self.close()
+
+    def _set_consumed(self):
+        with self._close_lock:
+            self._consumed = True
+            will_close = self._close_when_consumed
+
+        if will_close and self.status != "closed":
+            try:
+                self.close()
+            except Exception as e:
+                self.log.warning(f"failed to close statement: {e}")
 
     @retry(__name__)
     def _check_status(self):
         url = self.base_url + "/notebook/api/check_status"
-        payload = {
-            "notebook": json.dumps({
-                "id": None if "id" not in self.notebook else self.notebook["id"],
-                "uuid": self.notebook["uuid"],
-                "parentSavedQueryUuid": None,
-                "isSaved": self.notebook["isSaved"],
-                "sessions": self.notebook["sessions"],
-                "type": self.notebook["type"],
-                "name": self.notebook["name"],
-            }),
-            "snippet": json.dumps(self.snippet)
-        }
+        self._n_requests["check_status"] += 1
+        payload = self._payload()
         res = self._notebook.post(url, data=payload)
         return res
 
     def check_status(self, return_log=False, update_interval=60.):
+        self._n_polls += 1
         self.log.info(f"checking {'yarn app: ' + self._app_id if len(self._app_id) else 'status'}")
         if len(self._app_id) > 0:
             r_json = self._get_app_info(self._app_id).json()
             if 'message' in r_json:
                 self.log.warning(f"cannot find {self._app_id}")
-                return self.snippet["status"]
+                return self.status
 
             r_json = r_json["job"]
             progress = r_json["progress"]
@@ -823,17 +1088,27 @@ class NotebookResult(object):
                 else:
                     raise RuntimeError(r_json)
 
-            status = r_json["query_status"]["status"]
-            self.snippet["status"] = status
+            self.status = r_json["query_status"]["status"]
 
         if return_log:
             return cloud_log
-        return self.snippet["status"]
+        return self.status
 
-    def await_result(self, wait_sec: int = 1, print_log=False, progressbar=True, progressbar_offset=0):
+    def await_result(self, wait_sec: float = None, print_log=False, progressbar=True, progressbar_offset=0):
+        """
+        Block until result is available
+
+        :param wait_sec: seconds between polls, default to poll with adaptive intervals,
+                         see hue.poller.PollSchedule
+        :param print_log: whether to print cloud log during waiting
+        :param progressbar: whether to show progressbar during waiting
+        :param progressbar_offset: position of tqdm progressbar
+        """
         start_time = time.perf_counter()
+        schedule = PollSchedule()
+        interval = schedule.next_interval()
         while print_log:
-            time.sleep(wait_sec)
+            time.sleep(wait_sec if wait_sec is not None else interval)
             self.log.debug(f"awaiting result elapsed {time.perf_counter() - start_time:.2f} secs")
             cloud_log = self.check_status(return_log=print_log)
             if len(cloud_log) > 0:
@@ -842,12 +1117,13 @@ class NotebookResult(object):
             if self.is_ready():
                 self.log.debug(f"sql execution done in {time.perf_counter() - start_time:.2f} secs")
                 return
+            interval = schedule.next_interval(self._progress)
 
         if progressbar:
             self._progressbar = tqdm(total=100, position=progressbar_offset, **self._progressbar_format)
 
         while True:
-            time.sleep(wait_sec)
+            time.sleep(wait_sec if wait_sec is not None else interval)
             self.check_status()
             if progressbar:
                 self.update_progressbar(self._progressbar)
@@ -856,94 +1132,248 @@ class NotebookResult(object):
                 if progressbar:
                     self._progressbar.close()
                 return
+            interval = schedule.next_interval(self._progress)
 
-    @retry(__name__)
+    # timed out fetch is retried by caller with fewer rows at once
+    @retry(__name__, raise_on=(requests.exceptions.Timeout,))
     def _fetch_result(self, rows: int = None, start_over=False):
         self.log.debug(f"fetching result")
         url = self.base_url + f'/notebook/api/fetch_result_data/'
         payload = {
-            "notebook": json.dumps(self.notebook),
-            "snippet": json.dumps(self.snippet),
+            **self._payload(brief=False),
             "rows": rows if isinstance(rows, int) else self.rows_per_fetch,
             "startOver": "true" if start_over else "false"
             }
 
-        res = self._notebook.post(url, data=payload, stream=True)
+        res = self._notebook.post(url, data=payload, stream=True, timeout=HUE_FETCH_TIMEOUT_SECS)
         return res
 
-    def fetchall(self, progressbar=True, total=None, progressbar_offset=0):
-        self.log.info(f"fetching all")
-        if not self.is_ready():
-            self.log.warning(f"result {self.snippet['status']}")
+    def _iter_pages(self, rows: int = None):
+        """
+        Generator of raw result pages, when self.prefetch_pages > 0,
+        the next pages are requested and parsed by a background thread
+        while the current one is consumed
+        """
+        if self.prefetch_pages <= 0:
+            yield from self._fetch_pages(rows=rows)
+            return
+
+        end_of_pages = object()
+        pages = queue.Queue(maxsize=self.prefetch_pages)
+        stop = threading.Event()
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    pages.put(item, timeout=.1)
+                    return True
+                except queue.Full:
+                    continue
+            return False
 
+        def prefetch():
+            try:
+                for page in self._fetch_pages(rows=rows):
+                    if not put(page):
+                        return
+                put(end_of_pages)
+            except BaseException as e:
+                put(e)
+
+        fetcher = threading.Thread(target=prefetch,
+                                   name=f"NotebookResult[{self.name}]-prefetch",
+                                   daemon=True)
+        fetcher.start()
+        try:
+            while True:
+                page = pages.get()
+                if page is end_of_pages:
+                    return
+                if isinstance(page, BaseException):
+                    raise page
+
+                yield page
+                page = None
+        finally:
+            stop.set()
+            # make sure no request is in flight before result is fetched again
+            fetcher.join()
+
+    def _fetch_pages(self, rows: int = None):
+        """
+        Generator of raw result pages fetched from fetch_result_data api,
+        only the page being consumed is kept referenced.
+        If rows is not given and self.adaptive_fetch is True, rows per request
+        is steered by FetchSizeController, requests failed by proxy error or timeout
+        are transparently retried with fewer rows
+        """
+        controller = FetchSizeController(rows or self.rows_per_fetch,
+                                         adaptive=rows is None and self.adaptive_fetch)
+        n_yielded, n_skip = 0, 0
+        start_over = True
+        while True:
+            start_time = time.perf_counter()
+            try:
+                res = self._fetch_result(rows=controller.rows, start_over=start_over)
+                r_json, n_bytes = decode_response(res)
+                res = None
+            except (RuntimeError, requests.exceptions.Timeout) as e:
+                if isinstance(e, RuntimeError) and "proxy" not in str(e):
+                    raise e
+                if not controller.shrink():
+                    raise e
+
+                # the failed request might have moved server-side cursor forward,
+                # fetch from the start again and skip rows that were yielded
+                self.log.warning(f"fetching result failed, retry with {controller.rows} rows per fetch")
+                n_skip, start_over = n_yielded, True
+                continue
+
+            if r_json.get("status", 0) != 0 or "result" not in r_json:
+                self.log.error(f"fetching result failed: {r_json}")
+                raise RuntimeError(r_json.get("message", r_json))
+
+            page, r_json = r_json["result"], None
+            controller.update(n_rows=len(page["data"]),
+                              n_columns=len(page["meta"]),
+                              n_bytes=n_bytes,
+                              secs=time.perf_counter() - start_time)
+            start_over = False
+            if n_skip > 0:
+                n_dropped = min(n_skip, len(page["data"]))
+                del page["data"][: n_dropped]
+                n_skip -= n_dropped
+                if len(page["data"]) == 0 and page["has_more"]:
+                    continue
+
+            has_more = page["has_more"]
+            n_yielded += len(page["data"])
+            if not has_more:
+                self._set_consumed()
+            yield page
+            if not has_more:
+                return
+
+            # release last page before the next one arrives
+            page = None
+
+    def _setup_progressbar(self, total=None, progressbar_offset=0, result="fetchall"):
         if total is None:
             total, size = self.fetch_result_size()
 
-        if progressbar:
-            setup_progressbar = PROGRESSBAR.copy()
-            setup_progressbar["desc"] = setup_progressbar["desc"].format(
-                name=self.name,
-                result='fetchall')
-            if not isinstance(total, int):
-                setup_progressbar["bar_format"] = '{l_bar}{n_fmt}{unit}, {rate_fmt}{postfix} |{elapsed}'
-            else:
-                setup_progressbar["bar_format"] = '{l_bar}{bar:25}|[{elapsed}<{remaining}]'
-            pbar = tqdm(total=total,
-                        position=progressbar_offset,
-                        unit="rows",
-                        **setup_progressbar)
+        setup_progressbar = PROGRESSBAR.copy()
+        setup_progressbar["desc"] = setup_progressbar["desc"].format(
+            name=self.name,
+            result=result)
+        if not isinstance(total, int):
+            setup_progressbar["bar_format"] = '{l_bar}{n_fmt}{unit}, {rate_fmt}{postfix} |{elapsed}'
+        else:
+            setup_progressbar["bar_format"] = '{l_bar}{bar:25}|[{elapsed}<{remaining}]'
+        return tqdm(total=total,
+                    position=progressbar_offset,
+                    unit="rows",
+                    **setup_progressbar)
+
+    def iter_batches(self,
+                     rows_per_batch: int = None,
+                     typed=True,
+                     progressbar=False,
+                     total=None,
+                     progressbar_offset=0):
+        """
+        Iterate over result of executed sql one fetched page at a time,
+        memory usage is bounded to about one page regardless of result size.
 
-        res = self._fetch_result(start_over=True)
-        res = res.json()["result"]
+        :param rows_per_batch: rows to fetch per request, default to self.rows_per_fetch
+        :param typed: default True, build columns into typed arrays according to
+                      hive column types, see hue.convert.HIVE_DTYPES
+        :param progressbar: default to False, whether to show progressbar
+        :param total: a hint of rows passed by user,
+                      if None passed and show progressbar, will try fetch_result_size api
+        :param progressbar_offset: position of tqdm progressbar
 
-        lst_data = [[s if not isinstance(s, str)
-                     else '' if s == "NULL"
-                     else normalize("NFKC", unescape(s))
-                     for s in row]
-                    for row in res["data"]]
+        :return: generator of pandas.DataFrame, one per fetched page
+        """
+        self.log.info(f"iterating batches")
+        if not self.is_ready():
+            self.log.warning(f"result {self.status}")
+
+        batches = self._iter_batches(rows_per_batch=rows_per_batch,
+                                     typed=typed,
+                                     progressbar=progressbar,
+                                     total=total,
+                                     progressbar_offset=progressbar_offset)
+        if self._cache is not None and typed:
+            # result is written to cache as it is iterated
+            cache, key = self._cache
+            batches = cache.tee(key, batches, sql=self.handle.statement)
+
+        yield from batches
+
+    def _iter_batches(self, rows_per_batch=None, typed=True, progressbar=False, total=None, progressbar_offset=0):
+        pbar = self._setup_progressbar(total, progressbar_offset) if progressbar else None
+        normalizer = None
+        try:
+            for page in self._iter_pages(rows=rows_per_batch):
+                if normalizer is None:
+                    normalizer = ColumnNormalizer(page["meta"])
 
-        lst_metadata = [m["name"].rpartition(".")[2]
-                        for m in res["meta"]]
+                df = normalizer.to_frame(page["data"], typed=typed)
+                if pbar is not None:
+                    pbar.update(len(df))
 
-        if progressbar:
-            pbar.update(len(res["data"]))
+                yield df
+        finally:
+            if pbar is not None:
+                pbar.close()
 
-        while res["has_more"]:
-            res = self._fetch_result(start_over=False)
-            try:
-                res = res.json()["result"]
-            except MemoryError:
-                gc.collect()
-                res = res.json()["result"]
-            finally:
-                lst_data.extend([[s if not isinstance(s, str)
-                                  else '' if s == "NULL"
-                                  else normalize("NFKC", unescape(s))
-                                  for s in row]
-                                 for row in res["data"]])
-                if progressbar:
-                    pbar.update(len(res["data"]))
+    def to_frame(self, typed=True, progressbar=True, total=None, progressbar_offset=0):
+        """
+        Fetch all result of executed sql into a pandas.DataFrame,
+        columns are built page by page into typed arrays by hive column types
+
+        :param typed: default True, whether to build typed columns
+        :param progressbar: default to True, whether to show progressbar
+        :param total: a hint of rows passed by user,
+                      if None passed and show progressbar, will try fetch_result_size api
+        :param progressbar_offset: position of tqdm progressbar
+
+        :return: pandas.DataFrame
+        """
+        lst_df = list(self.iter_batches(typed=typed,
+                                        progressbar=progressbar,
+                                        total=total,
+                                        progressbar_offset=progressbar_offset))
+        if len(lst_df) == 1:
+            return lst_df[0]
+
+        return pd.concat(lst_df, ignore_index=True)
+
+    def fetchall(self, progressbar=True, total=None, progressbar_offset=0):
+        self.log.info(f"fetching all")
+        if not self.is_ready():
+            self.log.warning(f"result {self.status}")
+
+        pbar = self._setup_progressbar(total, progressbar_offset) if progressbar else None
+
+        lst_data, normalizer = [], None
+        for page in self._iter_pages():
+            if normalizer is None:
+                normalizer = ColumnNormalizer(page["meta"])
+
+            lst_data.extend(normalizer.normalize_rows(page["data"]))
+            if progressbar:
+                pbar.update(len(page["data"]))
 
         if progressbar:
             pbar.close()
-        self.data = {"data": lst_data, "columns": lst_metadata}
+        self.data = {"data": lst_data, "columns": normalizer.names}
         return self.data
 
     @retry(__name__)
     def _fetch_result_size(self):
         url = self.base_url + "/notebook/api/fetch_result_size"
-        payload = {
-            "notebook": json.dumps({
-                "id": None if "id" not in self.notebook else self.notebook["id"],
-                "uuid": self.notebook["uuid"],
-                "parentSavedQueryUuid": None,
-                "isSaved": self.notebook["isSaved"],
-                "sessions": self.notebook["sessions"],
-                "type": self.notebook["type"],
-                "name": self.notebook["name"],
-            }),
-            "snippet": json.dumps(self.snippet)
-        }
+        payload = self._payload()
         res = self._notebook.post(url, data=payload)
         return res
 
@@ -971,7 +1401,7 @@ class NotebookResult(object):
 
     def fetch_cloud_logs(self):
         self.log.debug("fetching cloud logs")
-        res = self._get_logs(self._logs_row, self.full_log)
+        res = self._get_logs(self._logs_row, self._server_log())
         cloud_log = res.json()
         if "logs" not in cloud_log:
             if "message" in cloud_log:
@@ -991,11 +1421,51 @@ class NotebookResult(object):
 
         self._progress = self._progress if self._progress > progress else progress
         if len(cloud_log) > 0:
-            self.full_log += "\n" + cloud_log if len(self.full_log) > 0 else cloud_log
-            self._logs_row += 1 + cloud_log.count("\n")
+            lines = cloud_log.split("\n")
+            self._log_lines.extend(lines)
+            for line in lines:
+                if JOB_LOG_PATTERN.search(line):
+                    self._job_log_lines.append(line)
+                else:
+                    self._tail_log_lines.append(line)
+            self._logs_row += len(lines)
 
         return cloud_log
 
+    @property
+    def full_log(self):
+        """
+        log of the query, at most the latest HUE_LOG_MAX_LINES lines are kept
+        """
+        return "\n".join(self._log_lines)
+
+    @property
+    def log_stats(self):
+        """
+        number of get_logs polls and bytes of log sent back to Hue
+        """
+        return {"polls": self._n_log_polls,
+                "bytes_sent": self._log_bytes_sent,
+                "bytes_per_poll": self._log_bytes_sent / max(self._n_log_polls, 1)}
+
+    @property
+    def poll_stats(self):
+        """
+        number of status polls and requests made by them per api
+        """
+        return {"polls": self._n_polls,
+                "requests": sum(self._n_requests.values()),
+                **self._n_requests}
+
+    def _server_log(self):
+        # Hue only parses jobs, MapReduce job counts and the latest progress from
+        # the log it receives, so send those lines instead of the whole log
+        server_log = "\n".join(chain(self._job_log_lines, self._tail_log_lines))
+
+        self._n_log_polls += 1
+        self._log_bytes_sent += len(server_log)
+        return server_log
+
     def update_progressbar(self, pbar, desc=None):
         if desc is None:
             desc = PROGRESSBAR["desc"].format(
@@ -1023,6 +1493,7 @@ class NotebookResult(object):
     @retry(__name__)
     def _get_app_info(self, app_id):
         url = HUE_BASE_URL + f"/jobbrowser/jobs/{app_id}"
+        self._n_requests["jobbrowser"] += 1
         res = self._notebook.get(url,
                                  params={"format": "json"}, )
         return res
@@ -1030,17 +1501,9 @@ class NotebookResult(object):
     @retry(__name__)
     def _get_logs(self, start_row, full_log):
         url = self.base_url + "/notebook/api/get_logs"
+        self._n_requests["get_logs"] += 1
         payload = {
-            "notebook": json.dumps({
-                "id": None if "id" not in self.notebook else self.notebook["id"],
-                "uuid": self.notebook["uuid"],
-                "parentSavedQueryUuid": None,
-                "isSaved": self.notebook["isSaved"],
-                "sessions": self.notebook["sessions"],
-                "type": self.notebook["type"],
-                "name": self.notebook["name"],
-            }),
-            "snippet": json.dumps(self.snippet),
+            **self._payload(),
             "from": start_row,
             "jobs": [],  # api won't read jobs, so pass an empty one won't do harm to anything
             "full_log": full_log
@@ -1049,6 +1512,178 @@ class NotebookResult(object):
         res = self._notebook.post(url, data=payload)
         return res
 
+    @retry(__name__)
+    def _download(self, file_format="csv"):
+        url = self.base_url + "/notebook/download"
+        payload = {
+            **self._payload(brief=False),
+            "format": file_format
+        }
+
+        res = self._notebook.post(url, data=payload, stream=True, timeout=HUE_FETCH_TIMEOUT_SECS)
+        return res
+
+    def download(self,
+                 file_name: str = None,
+                 format: str = "csv",
+                 encoding="utf-8",
+                 column_names: list = None,
+                 total: int = None,
+                 fallback=True,
+                 progressbar=True,
+                 progressbar_offset=0):
+        """
+        Download result of executed sql with Hue's result export,
+        the exported file is streamed to disk in chunks without being paged, parsed and normalized.
+        Result is fetched page by page instead when export is disabled on Hue,
+        when its size is unknown or beyond Hue's download limit HUE_EXPORT_MAX_ROWS,
+        or when it turns out truncated
+
+        :param file_name: default notebook name
+        :param format: "csv" or "xls", Hue exports excel as .xlsx
+        :param encoding: encoding of csv file, default to utf-8
+        :param column_names: column names of csv file to rename to, default to original names
+        :param total: number of rows the result has, default to fetch_result_size api,
+                      export with fewer rows is considered truncated
+        :param fallback: default True, whether to fetch result page by page when export fails,
+                         otherwise raise RuntimeError
+        :param progressbar: default to True, whether to show progressbar
+        :param progressbar_offset: position of tqdm progressbar
+
+        :return: path of downloaded file
+        """
+        if format not in ("csv", "xls"):
+            raise ValueError(f"unsupported download format '{format}', should be 'csv' or 'xls'")
+
+        abs_path = self._prepare_path(file_name, suffixes=("csv",) if format == "csv" else ("xlsx", "xls"))
+        if not self.is_ready():
+            self.log.warning(f"result {self.status}")
+
+        self.log.info(f"downloading to {abs_path}")
+        if self._cache is not None:
+            # page result so that it is written to cache as well
+            return self._download_by_pages(abs_path, format, encoding, column_names, total,
+                                           progressbar, progressbar_offset)
+
+        if total is None:
+            total, _ = self.fetch_result_size()
+        if fallback and (total is None or total > HUE_EXPORT_MAX_ROWS):
+            self.log.info(f"result has {'unknown' if total is None else total} rows "
+                          f"beyond export limit of {HUE_EXPORT_MAX_ROWS}, fetching result page by page")
+            return self._download_by_pages(abs_path, format, encoding, column_names, total,
+                                           progressbar, progressbar_offset)
+
+        res = self._download(format)
+        content_type = res.headers.get("Content-Type", "")
+        if res.status_code == 200 and "json" not in content_type and "html" not in content_type:
+            pbar = tqdm(total=None, unit="B", unit_scale=True, position=progressbar_offset,
+                        desc=self._progressbar_format["desc"]) if progressbar else None
+            try:
+                n_rows = self._write_export(res, abs_path, format, encoding, column_names, pbar)
+            finally:
+                res.close()
+                if pbar is not None:
+                    pbar.close()
+
+            if total is None or n_rows is None or n_rows >= total:
+                self._set_consumed()
+                return abs_path
+            error_msg = f"export truncated to {n_rows} of {total} rows by Hue"
+        else:
+            res.close()
+            error_msg = f"export is not available (http {res.status_code}, {content_type})"
+
+        if not fallback:
+            self.log.error(error_msg)
+            raise RuntimeError(error_msg)
+
+        self.log.warning(error_msg + ", fetching result page by page")
+        return self._download_by_pages(abs_path, format, encoding, column_names, total,
+                                       progressbar, progressbar_offset)
+
+    def _download_by_pages(self, abs_path, file_format, encoding, column_names, total,
+                           progressbar, progressbar_offset):
+        if file_format == "csv":
+            self.to_csv(abs_path, encoding=encoding, column_names=column_names, total=total,
+                        progressbar=progressbar, progressbar_offset=progressbar_offset)
+        else:
+            df = self.to_frame(progressbar=progressbar, total=total, progressbar_offset=progressbar_offset)
+            if column_names:
+                self._rename_columns(df, column_names)
+            df.to_excel(abs_path, index=False, engine=EXCEL_ENGINE)
+
+        return abs_path
+
+    def _write_export(self, res, abs_path: str, file_format: str, encoding: str, column_names: list, pbar):
+        """
+        stream exported file to disk, header of csv is rewritten to
+        column names without table prefix, rows are copied as they are
+
+        :return: number of csv rows written, None for excel
+        """
+        chunks = res.iter_content(chunk_size=HUE_EXPORT_CHUNK_SIZE)
+        with open(abs_path, "wb") as f:
+            if file_format != "csv":
+                for chunk in chunks:
+                    f.write(chunk)
+                    if pbar is not None:
+                        pbar.update(len(chunk))
+                return None
+
+            head = b""
+            for chunk in chunks:
+                head += chunk
+                if b"\n" in head:
+                    break
+
+            header, _, rest = head.partition(b"\n")
+            header = header.decode("utf-8-sig")
+            line_terminator = "\r\n" if header.endswith("\r") else "\n"
+            names = [name.rpartition(".")[2] for name in next(csv.reader([header.rstrip("\r")]))]
+            if column_names:
+                if len(names) != len(column_names):
+                    self.log.warning(f"length of table columns({len(names)}) "
+                                     f"mismatch with column_names({len(column_names)}), rename skipped")
+                else:
+                    names = column_names
+
+            buffer = io.StringIO()
+            csv.writer(buffer, lineterminator=line_terminator).writerow(names)
+            f.write(buffer.getvalue().encode(encoding))
+
+            # rows are copied byte by byte unless they have to be re-encoded,
+            # and counted by csv parser as quoted cells might contain line breaks
+            lines = self._iter_export_lines(chain([rest], chunks), f,
+                                            reencode=codecs.lookup(encoding).name != "utf-8",
+                                            encoding=encoding,
+                                            pbar=pbar)
+            return sum(1 for _ in csv.reader(lines))
+
+    @staticmethod
+    def _iter_export_lines(chunks, f, reencode: bool, encoding: str, pbar):
+        """
+        write chunks of exported csv to f and yield its decoded lines
+        """
+        decoder = codecs.getincrementaldecoder("utf-8")()
+        tail = ""
+        for chunk in chunks:
+            if len(chunk) == 0:
+                continue
+
+            text = decoder.decode(chunk)
+            f.write(text.encode(encoding) if reencode else chunk)
+            if pbar is not None:
+                pbar.update(len(chunk))
+
+            lines = (tail + text).split("\n")
+            tail = lines.pop()
+            for line in lines:
+                yield line + "\n"
+
+        tail += decoder.decode(b"", final=True)
+        if len(tail) > 0:
+            yield tail
+
     def to_csv(self,
                file_name: str = None,
                encoding="utf-8",
@@ -1068,73 +1703,132 @@ class NotebookResult(object):
         :param progressbar: default to True, whether to show progressbar
         :param encoding: file encoding, default to utf-8
         """
+        abs_path = self._prepare_path(file_name, suffixes=("csv",))
+        self.log.info(f"downloading to {abs_path}")
+        with open(abs_path, "w", newline="", encoding=encoding) as f:
+            for i, df in enumerate(self.iter_batches(progressbar=progressbar,
+                                                     total=total,
+                                                     progressbar_offset=progressbar_offset)):
+                if i == 0 and column_names:
+                    self._rename_columns(df, column_names)
+
+                df.to_csv(f, header=i == 0, index=False)
+
+    def to_parquet(self,
+                   file_name: str = None,
+                   row_group_size: int = None,
+                   compression: str = "snappy",
+                   column_names: list = None,
+                   total: int = None,
+                   progressbar=True,
+                   progressbar_offset=0):
+        """
+        Download result of executed sql directly into a parquet file,
+        each fetched page is written as one row group, so that memory usage is
+        bounded to about one page. Requires pyarrow.
+
+        :param file_name: default notebook name
+        :param row_group_size: rows per fetch and thus per row group,
+                               default to adapt to response size and latency
+        :param compression: parquet compression codec, default to snappy
+        :param column_names: column names to rename to, default to original names
+        :param total: a hint of rows passed by user,
+                      if None passed and show progressbar, will try fetch_result_size api
+        :param progressbar: default to True, whether to show progressbar
+        :param progressbar_offset: position of tqdm progressbar
+        """
+        import pyarrow.parquet as pq
+
+        abs_path = self._prepare_path(file_name, suffixes=("parquet", "pq"))
+        self.log.info(f"downloading to {abs_path}")
+        self._write_arrow(lambda schema: pq.ParquetWriter(abs_path, schema, compression=compression),
+                          rows_per_batch=row_group_size,
+                          column_names=column_names,
+                          total=total,
+                          progressbar=progressbar,
+                          progressbar_offset=progressbar_offset)
+
+    def to_feather(self,
+                   file_name: str = None,
+                   compression: str = None,
+                   column_names: list = None,
+                   total: int = None,
+                   progressbar=True,
+                   progressbar_offset=0):
+        """
+        Download result of executed sql directly into a feather (Arrow IPC) file,
+        each fetched page is written as record batches, so that memory usage is
+        bounded to about one page. Requires pyarrow.
+
+        :param file_name: default notebook name
+        :param compression: "lz4" or "zstd", default to uncompressed
+                            so that the file can be memory-mapped
+        :param column_names: column names to rename to, default to original names
+        :param total: a hint of rows passed by user,
+                      if None passed and show progressbar, will try fetch_result_size api
+        :param progressbar: default to True, whether to show progressbar
+        :param progressbar_offset: position of tqdm progressbar
+        """
+        import pyarrow as pa
+
+        abs_path = self._prepare_path(file_name, suffixes=("feather", "arrow", "ipc"))
+        self.log.info(f"downloading to {abs_path}")
+        options = pa.ipc.IpcWriteOptions(compression=compression)
+        self._write_arrow(lambda schema: pa.ipc.new_file(abs_path, schema, options=options),
+                          column_names=column_names,
+                          total=total,
+                          progressbar=progressbar,
+                          progressbar_offset=progressbar_offset)
+
+    def _write_arrow(self,
+                     open_writer,
+                     rows_per_batch: int = None,
+                     column_names: list = None,
+                     total: int = None,
+                     progressbar=True,
+                     progressbar_offset=0):
+        import pyarrow as pa
+
+        writer, schema = None, None
+        try:
+            for df in self.iter_batches(rows_per_batch=rows_per_batch,
+                                        progressbar=progressbar,
+                                        total=total,
+                                        progressbar_offset=progressbar_offset):
+                if writer is None and column_names:
+                    self._rename_columns(df, column_names)
+                elif writer is not None:
+                    df.columns = schema.names
+
+                table = pa.Table.from_pandas(df, preserve_index=False)
+                if writer is None:
+                    schema = widen_decimals(table.schema)
+                    writer = open_writer(schema)
+                # keep schema of the first page, e.g. a page of all null strings
+                table = table.cast(schema)
+
+                writer.write_table(table)
+        finally:
+            if writer is not None:
+                writer.close()
+
+    def _prepare_path(self, file_name: str, suffixes: tuple):
         if file_name is None:
-            file_name = os.path.join(os.getcwd(), self.name + ".csv")
+            file_name = os.path.join(os.getcwd(), self.name + "." + suffixes[0])
 
-        if file_name.rpartition(".")[2] != "csv":
-            file_name += ".csv"
+        if file_name.rpartition(".")[2] not in suffixes:
+            file_name += "." + suffixes[0]
 
         abs_dir = os.path.abspath(os.path.dirname(file_name))
         base_name = os.path.basename(file_name)
         if not os.path.exists(abs_dir):
             os.makedirs(abs_dir)
 
-        abs_path = os.path.join(abs_dir, base_name)
-
-        self.log.info(f"downloading to {abs_path}")
-        if progressbar:
-            if total is None:
-                total, size = self.fetch_result_size()
-
-            setup_progressbar = PROGRESSBAR.copy()
-            setup_progressbar["desc"] = setup_progressbar["desc"].format(
-                name=self.name,
-                result='fetchall')
-            if not isinstance(total, int):
-                setup_progressbar["bar_format"] = '{l_bar}{n_fmt}{unit}, {rate_fmt}{postfix} |{elapsed}'
-            else:
-                setup_progressbar["bar_format"] = '{l_bar}{bar:25}|[{elapsed}<{remaining}]'
-            pbar = tqdm(total=total,
-                        position=progressbar_offset,
-                        unit="rows",
-                        **setup_progressbar)
-
-        with open(abs_path, "w", newline="", encoding=encoding) as f:
-            writer = csv.writer(f)
-
-            res = self._fetch_result(start_over=True)
-            res = res.json()["result"]
-            lst_data = [[s if not isinstance(s, str)
-                         else '' if s == "NULL"
-                         else normalize("NFKC", unescape(s))
-                         for s in row]
-                        for row in res["data"]]
-
-            lst_metadata = [m["name"].rpartition(".")[2]
-                            for m in res["meta"]]
-
-            if column_names:
-                writer.writerow(column_names)
-            else:
-                writer.writerow(lst_metadata)
+        return os.path.join(abs_dir, base_name)
 
-            writer.writerows(lst_data)
-
-            if progressbar:
-                pbar.update(len(res["data"]))
-
-            while res["has_more"]:
-                res = self._fetch_result(start_over=False)
-                res = res.json()["result"]
-                lst_data = [[s if not isinstance(s, str)
-                             else '' if s == "NULL"
-                             else normalize("NFKC", unescape(s))
-                             for s in row]
-                            for row in res["data"]]
-
-                writer.writerows(lst_data)
-                if progressbar:
-                    pbar.update(len(res["data"]))
-
-        if progressbar:
-            pbar.close()
+    def _rename_columns(self, df, column_names: list):
+        if len(df.columns) != len(column_names):
+            self.log.warning(f"length of table columns({len(df.columns)}) "
+                             f"mismatch with column_names({len(column_names)}), rename skipped")
+        else:
+            df.columns = column_names
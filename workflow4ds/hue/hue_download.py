@@ -1,10 +1,15 @@
 import base64
+import csv
+import importlib.util
 import json
 import os
 import re
+import tempfile
 import time
+import warnings
 import getpass
 from concurrent.futures import ThreadPoolExecutor
+from itertools import zip_longest
 from io import BytesIO, StringIO, IOBase
 
 import numpy as np
@@ -15,8 +20,11 @@ from PIL import Image
 from requests_toolbelt import MultipartEncoder
 import logging
 
-from ..settings import HUE_DOWNLOAD_BASE_URL, EXCEL_ENGINE
+from ..settings import HUE_DOWNLOAD_BASE_URL, HUE_DOWNLOAD_MAX_COLUMNS, HUE_EXPORT_CHUNK_SIZE, \
+    HUE_UPLOAD_CHUNK_ROWS, EXCEL_ENGINE
 from ..decorators import retry, ensure_login
+from ..utils import count_csv_rows
+from .poller import DownloadStatusTracker
 from .. import logger
 
 
@@ -38,6 +46,7 @@ class HueDownload(requests.Session):
         self.log.debug("loading img_dict")
         self.benchmark_imgs = np.load(os.path.join(os.path.dirname(__file__), "img_dict.npy"), allow_pickle=True).item()
         super(HueDownload, self).__init__()
+        self.download_tracker = DownloadStatusTracker(self._get_download_info, verbose=verbose)
 
         self.login(self.username, self._password)
 
@@ -194,8 +203,11 @@ class HueDownload(requests.Session):
                  decrypt_columns: list = None,
                  limit: int = None,
                  path: str = None,
-                 wait_sec: int = 5,
+                 wait_sec: int = None,
                  timeout: float = float("inf"),
+                 dtype: dict = None,
+                 max_columns: int = HUE_DOWNLOAD_MAX_COLUMNS,
+                 n_jobs: int = 4,
                  **info_kwargs
                  ):
         """
@@ -213,12 +225,16 @@ class HueDownload(requests.Session):
         :param path: output csv file if specified.
                      default to return Pandas.DataFrame
                      this is designed to download large table without using up memory
-        :param wait_sec: time interval while waiting server for preparing for download
-                         default to 5 seconds
+        :param wait_sec: deprecated, see prepare
         :param timeout: maximum seconds to wait for the server preparation
                        default to wait indefinitely
-        :param info_kwargs: to modify get_info_by_id parameters, add argument pairs here
-                            (useful when downloadables cannot be found in just one page)
+        :param dtype: data types of columns to parse as when returning Pandas.DataFrame or saving excel,
+                      passed to pandas.read_csv
+        :param max_columns: tables with more columns are downloaded in column shards of max_columns,
+                            shards are prepared in parallel and stitched row by row into one csv
+        :param n_jobs: maximum number of column shards prepared at the same time
+        :param info_kwargs: "size" enlarges listing page of download_tracker,
+                            status is found on further pages anyway
 
         :return: Pandas.DataFrame if path is not specified,
                  otherwise output a csv file to path and return None
@@ -233,6 +249,136 @@ class HueDownload(requests.Session):
                                  f"mismatch with column_names({len(column_names)}), rename skipped")
                 column_names = None
 
+        if len(columns) > max_columns:
+            return self._download_column_shards(table=table,
+                                                reason=reason,
+                                                columns=columns,
+                                                column_names=column_names,
+                                                decrypt_columns=decrypt_columns,
+                                                limit=limit,
+                                                path=path,
+                                                timeout=timeout,
+                                                dtype=dtype,
+                                                max_columns=max_columns,
+                                                n_jobs=n_jobs,
+                                                **info_kwargs)
+
+        download_id = self.prepare(table=table,
+                                   reason=reason,
+                                   columns=columns,
+                                   decrypt_columns=decrypt_columns,
+                                   limit=limit,
+                                   wait_sec=wait_sec,
+                                   timeout=timeout,
+                                   **info_kwargs)
+        return self.download_by_id(download_id=download_id, path=path, column_names=column_names, dtype=dtype)
+
+    def _download_column_shards(self,
+                                table: str,
+                                reason: str,
+                                columns: list,
+                                column_names: list,
+                                decrypt_columns: list,
+                                limit: int,
+                                path: str,
+                                timeout: float,
+                                dtype: dict,
+                                max_columns: int,
+                                n_jobs: int,
+                                **info_kwargs):
+        """
+        download groups of columns in parallel to temporary files,
+        then stitch them row by row, so that no more than one row of every shard is in memory
+        """
+        lst_columns = [columns[i: i + max_columns] for i in range(0, len(columns), max_columns)]
+        self.log.info(f"downloading {len(columns)} columns of {table} in {len(lst_columns)} shards")
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            lst_paths = [os.path.join(tmp_dir, f"shard{i}.csv") for i in range(len(lst_columns))]
+
+            def download_shard(i):
+                shard_decrypt_columns = [col for col in decrypt_columns or [] if col in lst_columns[i]]
+                download_id = self.prepare(table=table,
+                                           reason=f"{reason} part {i}" if reason else reason,
+                                           columns=lst_columns[i],
+                                           decrypt_columns=shard_decrypt_columns or None,
+                                           limit=limit,
+                                           timeout=timeout,
+                                           **info_kwargs)
+                self.download_by_id(download_id=download_id, path=lst_paths[i])
+
+            with ThreadPoolExecutor(max_workers=max(1, min(n_jobs, len(lst_columns)))) as executor:
+                for future in [executor.submit(download_shard, i) for i in range(len(lst_columns))]:
+                    future.result()
+
+            suffix = path.rpartition(".")[-1] if isinstance(path, str) else None
+            csv_path = path if path is not None and suffix not in ("xlsx", "xls", "xlsm") \
+                else os.path.join(tmp_dir, "stitched.csv")
+            self._stitch_csv(lst_paths, csv_path, column_names=column_names)
+            if path is None:
+                return pd.read_csv(csv_path, dtype=dtype)
+            if csv_path != path:
+                pd.read_csv(csv_path, dtype=dtype).to_excel(path, index=False, engine=EXCEL_ENGINE)
+
+    def _stitch_csv(self, src_paths: list, dst_path: str, column_names: list = None):
+        """
+        concatenate csv files column-wise, row i of output consists of row i of every file in order
+        """
+        files = [open(src_path, "r", encoding="utf-8-sig", newline="") for src_path in src_paths]
+        try:
+            readers = [csv.reader(f) for f in files]
+            with open(dst_path, "w", encoding="utf-8", newline="") as f:
+                writer = csv.writer(f, lineterminator="\n")
+                header = [name for reader in readers for name in next(reader, [])]
+                writer.writerow(column_names or header)
+                for rows in zip_longest(*readers):
+                    if any(row is None for row in rows):
+                        raise RuntimeError(f"column shards have different numbers of rows: "
+                                           f"{[row is not None for row in rows]}")
+                    writer.writerow([value for row in rows for value in row])
+        finally:
+            for f in files:
+                f.close()
+
+    def prepare(self,
+                table: str,
+                reason: str,
+                columns: list = None,
+                decrypt_columns: list = None,
+                limit: int = None,
+                wait_sec: int = None,
+                timeout: float = float("inf"),
+                **info_kwargs
+                ):
+        """
+        submit a download of table and wait for the server to prepare it,
+        the prepared data is then fetched by download_by_id
+
+        :param table: table name on Hue (database name is required)
+        :param reason:  reason of downloading
+        :param columns: specify which of the columns in table to download from Hue,
+                        default to all columns
+        :param decrypt_columns: columns to be decrypted
+        :param limit: the maximum number of records to be downloaded
+                      default to all records
+        :param wait_sec: deprecated and ignored, status of downloads in flight is polled by
+                         download_tracker every download_tracker.interval seconds,
+                         set that or HUE_DOWNLOAD_STATUS_INTERVAL in settings instead
+        :param timeout: maximum seconds to wait for the server preparation
+                       default to wait indefinitely
+        :param info_kwargs: "size" enlarges listing page of download_tracker
+
+        :return: download id
+        """
+        if wait_sec is not None:
+            warnings.warn("wait_sec of HueDownload.prepare is deprecated and ignored, "
+                          "set download_tracker.interval instead",
+                          DeprecationWarning, stacklevel=2)
+        if columns is None:
+            columns = self.get_column(table)
+        if decrypt_columns is not None:
+            columns = pd.unique(columns + decrypt_columns).tolist()
+
         res = self._download(
             table=table,
             reason=reason,
@@ -248,29 +394,25 @@ class HueDownload(requests.Session):
 
         download_id = r_json["id"]
         start_time = time.perf_counter()
-        while time.perf_counter() - start_time < timeout:
-            time.sleep(wait_sec)
-            download_info = self.get_info_by_id(download_id, info_type="download", **info_kwargs)
-            if download_info["status"] == 0:
-                # status: submit
-                self.log.info(f"prepare {table} elapsed: {time.perf_counter() - start_time:.2f}/{timeout} secs")
-                continue
-            if self.verbose:
-                print()
-            if download_info["status"] == 1:
-                # status: failed
-                raise RuntimeError(error_msg)
-            if download_info["status"] == 3:
-                # status: success
-                return self.download_by_id(download_id=download_id, path=path, column_names=column_names)
-            else:
-                self.log.error(f"can't resolve download info: {download_info}")
-                raise RuntimeError(f"can't resolve download info: {download_info}")
+        # status of all downloads in flight is polled by one shared listing
+        if "size" in info_kwargs:
+            self.download_tracker.page_size = max(self.download_tracker.page_size, info_kwargs["size"])
+        try:
+            download_info = self.download_tracker.wait(download_id, timeout=timeout)
+        except TimeoutError:
+            self.log.error(f"download {table} timed out")
+            raise TimeoutError(f"download {table} timed out")
+
+        self.log.info(f"prepare {table} elapsed: {time.perf_counter() - start_time:.2f}/{timeout} secs")
+        if download_info["status"] == 1:
+            # status: failed
+            raise RuntimeError(error_msg)
+        if download_info["status"] == 3:
+            # status: success
+            return download_id
 
-        if self.verbose:
-            print()
-        self.log.error(f"download {table} timed out")
-        return TimeoutError(f"download {table} timed out")
+        self.log.error(f"can't resolve download info: {download_info}")
+        raise RuntimeError(f"can't resolve download info: {download_info}")
 
     @ensure_login
     def upload_data(self,
@@ -344,13 +486,15 @@ class HueDownload(requests.Session):
                nrows: int = None,
                wait_sec: int = 5,
                timeout: float = float("inf"),
+               file_format: str = "csv",
                **info_kwargs
                ):
         """
         a refactored version of upload_data from WxCustom
         parse upload data and call upload API, if success, return uploaded table name.
+        csv and parquet are streamed chunk by chunk, they are never held in memory as a whole
 
-        :param data: pandas.DataFrame, pandas.Series or path str to xlsx, xls or csv file
+        :param data: pandas.DataFrame, pandas.Series or path str to xlsx, xls, csv or parquet file
         :param reason: str, upload reason
         :param columns: list, list of columns to upload
         :param column_names: list, list of column with respective to their alias,
@@ -361,17 +505,49 @@ class HueDownload(requests.Session):
                          default to 5 seconds
         :param timeout: maximum seconds to wait for the server preparation
                         default to wait indefinitely
+        :param file_format: "csv" (default) or "xlsx", format DataFrame and parquet are uploaded in,
+                            csv is serialized in chunks, xlsx is built in memory and much slower
         :param info_kwargs: to modify get_info_by_id parameters, add argument pairs here
                             (useful when upload contents cannot be found in just one page)
 
         :return: str, name of uploaded table
         """
-
-        if isinstance(data, (pd.DataFrame, pd.Series)):
+        if file_format not in ("csv", "xlsx"):
+            raise ValueError(f"file_format should be either 'csv' or 'xlsx', got '{file_format}'")
+
+        is_parquet = isinstance(data, str) and re.findall(r'\.parquet$|\.pq$', data)
+        if is_parquet:
+            if not importlib.util.find_spec("pyarrow"):
+                raise ImportError("uploading parquet requires pyarrow, please install it via pip")
+            import pyarrow.parquet as pq
+
+            parquet_file = pq.ParquetFile(data)
+            columns = columns or parquet_file.schema_arrow.names
+            nrows = nrows or parquet_file.metadata.num_rows
+            if file_format == "xlsx":
+                data = parquet_file.read().to_pandas()
+
+        tmp_dir = None
+        if isinstance(data, pd.Series):
+            data = data.to_frame()
+
+        if isinstance(data, pd.DataFrame) and file_format == "xlsx":
             buffer = BytesIO()
             buffer.name = "pd.DataFrame.xlsx"
             data.to_excel(buffer, index=False)
             columns, nrows = columns or data.columns, nrows or data.shape[0]
+        elif isinstance(data, pd.DataFrame) or is_parquet:
+            # MultipartEncoder needs length of file up front,
+            # so csv chunks are spooled to a temporary file and streamed from there
+            tmp_dir = tempfile.TemporaryDirectory()
+            path = os.path.join(tmp_dir.name, "pd.DataFrame.csv")
+            with open(path, "wb") as f:
+                for chunk in self._iter_csv_chunks(parquet_file if is_parquet else data):
+                    f.write(chunk)
+
+            if not is_parquet:
+                columns, nrows = columns or data.columns, nrows or data.shape[0]
+            buffer = open(path, "rb")
         elif isinstance(data, str) and re.findall('\.xlsx$|\.xls$|\.xlsm$|\.xltx$|\.xltm$', data):
             # instead of read all data in memory using pd.read_...
             # read only necessary column info and row count
@@ -389,12 +565,14 @@ class HueDownload(requests.Session):
             wb.close()
             buffer = open(data, "rb")
         elif isinstance(data, str) and re.findall('\.csv$', data):
+            # read only header and scan line breaks for row count, rows are never parsed
+            with open(data, "r", encoding="utf-8-sig", newline="") as f:
+                columns = columns or next(csv.reader(f), [])
+            nrows = nrows or count_csv_rows(data)
             buffer = open(data, "rb")
-            data = pd.read_csv(data)
-            columns, nrows = columns or data.columns, nrows or data.shape[0]
         else:
             raise RuntimeError('data format is not supported yet,'
-                               ' please upload DataFrame, csv or xlsx with english title')
+                               ' please upload DataFrame, csv, parquet or xlsx with english title')
         if encrypt_columns:
             set_encrypt_columns, set_columns = set(encrypt_columns), set(columns)
             if not set_encrypt_columns.issubset(set_columns):
@@ -402,16 +580,22 @@ class HueDownload(requests.Session):
                           f" {','.join(set_encrypt_columns.difference(set_columns))}" \
                           f" not in {buffer.name}"
                 buffer.close()
+                if tmp_dir is not None:
+                    tmp_dir.cleanup()
                 self.log.error(err_msg)
                 raise ValueError(err_msg)
 
-        res = self._upload(file_buffer=buffer,
-                           reason=reason,
-                           columns=columns,
-                           column_names=','.join(column_names) if column_names else '',
-                           encrypt_columns=','.join(encrypt_columns) if encrypt_columns else '',
-                           nrows=nrows or -1)
-        buffer.close()
+        try:
+            res = self._upload(file_buffer=buffer,
+                               reason=reason,
+                               columns=columns,
+                               column_names=','.join(column_names) if column_names else '',
+                               encrypt_columns=','.join(encrypt_columns) if encrypt_columns else '',
+                               nrows=nrows or -1)
+        finally:
+            buffer.close()
+            if tmp_dir is not None:
+                tmp_dir.cleanup()
         id_ = res.json()['id']
         error_msg = f"cannot upload {buffer.name}, please check table name and (encrypt) column names"
         start_time = time.perf_counter()
@@ -432,6 +616,21 @@ class HueDownload(requests.Session):
         self.log.error(f"upload {buffer.name} timed out")
         return TimeoutError(f"upload {buffer.name} timed out")
 
+    @staticmethod
+    def _iter_csv_chunks(data, rows_per_chunk: int = HUE_UPLOAD_CHUNK_ROWS):
+        """
+        serialize pandas.DataFrame or pyarrow.parquet.ParquetFile to csv bytes chunk by chunk
+        """
+        if isinstance(data, pd.DataFrame):
+            batches = (data.iloc[i: i + rows_per_chunk] for i in range(0, max(len(data), 1), rows_per_chunk))
+        else:
+            batches = (batch.to_pandas() for batch in data.iter_batches(batch_size=rows_per_chunk))
+
+        header = True
+        for df in batches:
+            yield df.to_csv(index=False, header=header).encode("utf-8")
+            header = False
+
     def get_info_by_id(self, id_: int, info_type, **kwargs):
         if info_type == 'upload' or info_type == 1:
             func_info = self._get_upload_info
@@ -451,11 +650,25 @@ class HueDownload(requests.Session):
 
         raise LookupError(f"cannot get info with download id: {id_}")
 
-    def download_by_id(self, download_id, column_names=None, path=None):
+    def download_by_id(self, download_id, column_names=None, path=None, dtype=None):
+        """
+        fetch a prepared download, data is parsed or saved straight from the streamed response
+
+        :param download_id: id returned by prepare
+        :param column_names: rename column names if needed
+        :param path: output file if specified, csv is saved as it is except for renamed header,
+                     default to return Pandas.DataFrame
+        :param dtype: data types of columns to parse as, passed to pandas.read_csv,
+                      it saves type inference and avoids mixed types within a column
+        """
         start_time = time.perf_counter()
         buffer = self._download_by_id(download_id)
+        if buffer.status_code != 200:
+            self.log.error(f"cannot download by id {download_id}: {buffer.status_code} {buffer.reason}")
+            raise RuntimeError(f"cannot download by id {download_id}: {buffer.status_code} {buffer.reason}")
+
         if path is None:
-            df = pd.read_csv(StringIO(buffer.text))
+            df = self._read_csv(buffer, dtype=dtype)
             if column_names:
                 df.columns = column_names
 
@@ -466,22 +679,58 @@ class HueDownload(requests.Session):
 
         suffix = path.rpartition(".")[-1]
         if suffix in ("xlsx", "xls", "xlsm"):
-            df = pd.read_csv(StringIO(buffer.text))
+            df = self._read_csv(buffer, dtype=dtype)
             if column_names:
                 df.columns = column_names
 
             df.to_excel(path, index=False, engine=EXCEL_ENGINE)
-        elif column_names:
-            df = pd.read_csv(StringIO(buffer.text))
-            df.columns = column_names
-            df.to_csv(path, index=False, encoding="utf-8")
         else:
-            with open(path, "wb") as f:
-                for chunk in buffer.iter_content(chunk_size=8192):
-                    f.write(chunk)
+            self._write_csv(buffer, path, column_names=column_names)
 
         self.log.info(f"download finished in {time.perf_counter() - start_time:.3f} secs")
 
+    def _read_csv(self, res, dtype=None):
+        # the parser reads the response stream chunk by chunk,
+        # so that the body is never held in memory as bytes or string
+        res.raw.decode_content = True
+        try:
+            return pd.read_csv(res.raw, dtype=dtype, encoding=res.encoding or "utf-8")
+        finally:
+            res.close()
+
+    def _write_csv(self, res, path, column_names=None):
+        """
+        stream csv to path, only the header line is rewritten if column_names is given
+        """
+        chunks = res.iter_content(chunk_size=HUE_EXPORT_CHUNK_SIZE)
+        try:
+            with open(path, "wb") as f:
+                if column_names:
+                    head = b""
+                    for chunk in chunks:
+                        head += chunk
+                        if b"\n" in head:
+                            break
+
+                    header, newline, rest = head.partition(b"\n")
+                    line_terminator = "\r\n" if header.endswith(b"\r") else "\n"
+                    encoding = res.encoding or "utf-8"
+                    n_columns = len(next(csv.reader([header.decode(encoding).rstrip("\r")])))
+                    if n_columns != len(column_names):
+                        raise ValueError(f"length of table columns({n_columns}) "
+                                         f"mismatch with column_names({len(column_names)})")
+
+                    buffer = StringIO()
+                    csv.writer(buffer, lineterminator=line_terminator).writerow(column_names)
+                    f.write(buffer.getvalue().encode(encoding) if len(newline) else
+                            buffer.getvalue().rstrip(line_terminator).encode(encoding))
+                    f.write(rest)
+
+                for chunk in chunks:
+                    f.write(chunk)
+        finally:
+            res.close()
+
     @ensure_login
     @retry(__name__)
     def _get_column(self, table_name):
@@ -541,8 +790,8 @@ class HueDownload(requests.Session):
             file = (os.path.basename(file_buffer.name), file_buffer)
         upload_info['file'] = file
         data = MultipartEncoder(fields=upload_info)
-        self.headers['Content-Type'] = data.content_type
-        res = self.post(url, data=data)
+        # content type is set per request, session headers are shared by concurrent uploads
+        res = self.post(url, data=data, headers={'Content-Type': data.content_type})
         return res
 
     @ensure_login
@@ -0,0 +1,139 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+
+from .. import logger
+
+__all__ = ["DownloadManifest"]
+
+
+def file_sha256(path: str, chunk_size: int = 1 << 20):
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+class DownloadManifest(object):
+    """
+    Progress of a large table download split into chunks of temporary tables,
+    saved as json next to the output file so that a failed download can be resumed.
+    It records the temporary tables, whether they are filled,
+    and download id, size and checksum of every chunk file downloaded
+
+    Parameters:
+    path: str, path of manifest file
+    table: str, table to download
+    options: dict, download options that determine chunk contents,
+        a saved manifest is only resumed with the same options
+    verbose: bool, default False
+        whether to print log on stdout
+    """
+
+    def __init__(self,
+                 path: str,
+                 table: str,
+                 options: dict = None,
+                 verbose: bool = False):
+        self.path = path
+        self.table = table
+        self.options = options or {}
+        self.inserted = False
+        self.chunks = []
+
+        self.log = logging.getLogger(__name__ + ".DownloadManifest")
+        if verbose:
+            logger.set_stream_log_level(self.log, verbose=verbose)
+
+        self._lock = threading.Lock()
+
+    @classmethod
+    def load(cls, path: str, table: str, options: dict = None, verbose: bool = False):
+        """
+        load a saved manifest
+
+        :return: DownloadManifest, None if not found or saved for another table or options
+        """
+        manifest = cls(path, table, options, verbose=verbose)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                content = json.load(f)
+        except FileNotFoundError:
+            return None
+        except ValueError as e:
+            manifest.log.warning(f"ignoring unreadable manifest '{path}': {e}")
+            return None
+
+        # options are compared after a json round-trip, as tuples are saved as lists
+        if content.get("table") != table \
+                or content.get("options") != json.loads(json.dumps(manifest.options)):
+            manifest.log.warning(f"manifest '{path}' was saved for another download, ignored")
+            return None
+
+        manifest.inserted = content["inserted"]
+        manifest.chunks = content["chunks"]
+        return manifest
+
+    @property
+    def tmp_tables(self):
+        return [chunk["table"] for chunk in self.chunks]
+
+    def reset(self, tmp_tables: list, paths: list):
+        """
+        start over with new temporary tables, all downloaded chunks are discarded
+        """
+        self.inserted = False
+        self.chunks = [{"table": tmp_table, "path": path, "download_id": None, "bytes": None, "sha256": None}
+                       for tmp_table, path in zip(tmp_tables, paths)]
+        self.save()
+
+    def save(self):
+        with self._lock:
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump({"table": self.table,
+                           "options": self.options,
+                           "inserted": self.inserted,
+                           "chunks": self.chunks},
+                          f, indent=2)
+            os.replace(tmp_path, self.path)
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def set_download_id(self, chunk: dict, download_id: int):
+        chunk["download_id"] = download_id
+        self.save()
+
+    def commit(self, chunk: dict):
+        """
+        record size and checksum of a downloaded chunk file
+        """
+        chunk["bytes"] = os.path.getsize(chunk["path"])
+        chunk["sha256"] = file_sha256(chunk["path"])
+        self.save()
+
+    def is_complete(self, chunk: dict):
+        """
+        whether chunk file is downloaded and intact
+        """
+        if chunk["sha256"] is None:
+            return False
+
+        try:
+            if os.path.getsize(chunk["path"]) != chunk["bytes"]:
+                self.log.warning(f"chunk '{chunk['path']}' has unexpected size, it will be downloaded again")
+                return False
+        except FileNotFoundError:
+            self.log.warning(f"chunk '{chunk['path']}' is missing, it will be downloaded again")
+            return False
+
+        if file_sha256(chunk["path"]) != chunk["sha256"]:
+            self.log.warning(f"chunk '{chunk['path']}' is corrupt, it will be downloaded again")
+            return False
+
+        return True
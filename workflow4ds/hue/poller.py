@@ -0,0 +1,337 @@
+import heapq
+import itertools
+import logging
+import queue
+import threading
+import time
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+
+from .. import logger
+from ..settings import HUE_POLL_MIN_SECS, HUE_POLL_MAX_SECS, HUE_POLL_BACKOFF_FACTOR, \
+    HUE_DOWNLOAD_STATUS_PAGE_SIZE, HUE_DOWNLOAD_STATUS_INTERVAL, HUE_DOWNLOAD_STATUS_MAX_FAILURES
+
+__all__ = ["PollSchedule", "StatusPoller", "DownloadStatusTracker"]
+
+
+class PollSchedule(object):
+    """
+    Adaptive polling interval of a running query.
+    Polls quickly at first and backs off exponentially up to a cap while progress stays the same.
+    When progress changes, the backoff restarts from a tenth of the time to completion
+    predicted by the progress trend, and never sleeps past the predicted completion
+
+    Parameters:
+    min_interval: float, default HUE_POLL_MIN_SECS in settings
+        first and smallest polling interval
+    max_interval: float, default HUE_POLL_MAX_SECS in settings
+        largest polling interval
+    factor: float, default HUE_POLL_BACKOFF_FACTOR in settings
+        interval grows by this factor on each poll without progress
+    """
+
+    def __init__(self,
+                 min_interval: float = HUE_POLL_MIN_SECS,
+                 max_interval: float = HUE_POLL_MAX_SECS,
+                 factor: float = HUE_POLL_BACKOFF_FACTOR):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.factor = factor
+        self.interval = None
+        self.progress = None
+        self.n_polls = 0
+        # (time, progress) of latest progress changes
+        self._trend = deque(maxlen=8)
+
+    @property
+    def eta(self):
+        """
+        seconds to completion predicted by the progress trend,
+        None if unknown, 0 if the prediction has passed
+        """
+        if len(self._trend) < 2:
+            return None
+
+        (t0, p0), (t1, p1) = self._trend[0], self._trend[-1]
+        if p1 <= p0 or t1 <= t0:
+            return None
+
+        rate = (p1 - p0) / (t1 - t0)
+        return max(0., (100. - p1) / rate - (time.perf_counter() - t1))
+
+    def next_interval(self, progress: float = None):
+        """
+        seconds to wait before the next poll
+
+        :param progress: latest query progress in percent, None if not known
+        """
+        self.n_polls += 1
+        if progress is not None and progress != self.progress:
+            self.progress = progress
+            self._trend.append((time.perf_counter(), progress))
+            eta = self.eta
+            self.interval = self.min_interval if eta is None else eta / 10
+        elif self.interval is None:
+            self.interval = self.min_interval
+        else:
+            self.interval *= self.factor
+
+        self.interval = min(max(self.interval, self.min_interval), self.max_interval)
+        eta = self.eta
+        if eta:
+            return min(self.interval, max(eta, self.min_interval))
+        return self.interval
+
+
+class StatusPoller(object):
+    """
+    Poll status of in-flight NotebookResults concurrently on a small thread pool,
+    so that a slow response of one query never delays the others or the submission of new queries.
+    Each query is polled on its own PollSchedule.
+    Finished queries are delivered through a queue, see self.get
+
+    Parameters:
+    n_threads: int, default 4
+        number of threads polling status at the same time
+    wait_ready: bool, default True
+        whether a query is delivered only when its result is available,
+        otherwise it is delivered after the first poll
+    min_interval: float, default HUE_POLL_MIN_SECS in settings
+        seconds between submission and the first poll, and the smallest polling interval
+    max_interval: float, default HUE_POLL_MAX_SECS in settings
+        largest polling interval
+    verbose: bool, default False
+        whether to print log on stdout
+    """
+
+    def __init__(self,
+                 n_threads: int = 4,
+                 wait_ready: bool = True,
+                 min_interval: float = HUE_POLL_MIN_SECS,
+                 max_interval: float = HUE_POLL_MAX_SECS,
+                 verbose: bool = False):
+        self.wait_ready = wait_ready
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+
+        self.log = logging.getLogger(__name__ + ".StatusPoller")
+        if verbose:
+            logger.set_stream_log_level(self.log, verbose=verbose)
+
+        self._executor = ThreadPoolExecutor(max_workers=max(1, n_threads),
+                                            thread_name_prefix="hue-poller")
+        self._completions = queue.Queue()
+        # heap of (due time, sequence, key, result, schedule)
+        self._schedule = []
+        self._seq = itertools.count()
+        self._n_pending = 0
+        self._cond = threading.Condition()
+        self._closed = False
+        self._scheduler = threading.Thread(target=self._run, name="hue-poller-scheduler", daemon=True)
+        self._scheduler.start()
+
+    def __len__(self):
+        with self._cond:
+            return self._n_pending
+
+    def submit(self, key, result):
+        """
+        start polling a result
+
+        :param key: hashable, returned with the result by self.get
+        :param result: NotebookResult of an executed sql
+        """
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("poller is closed")
+
+            self._n_pending += 1
+            schedule = PollSchedule(self.min_interval, self.max_interval)
+            self._push(key, result, schedule, schedule.next_interval())
+
+    def get(self, timeout: float = None):
+        """
+        wait for the next finished query
+
+        :param timeout: seconds to wait, raises queue.Empty when exceeded
+        :return: tuple of key, result and exception raised while polling (None if no exception)
+        """
+        key, result, exception = self._completions.get(timeout=timeout)
+        with self._cond:
+            self._n_pending -= 1
+        return key, result, exception
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._schedule.clear()
+            self._cond.notify_all()
+
+        self._scheduler.join()
+        self._executor.shutdown(wait=True)
+
+    def _push(self, key, result, schedule, interval):
+        due = time.perf_counter() + interval
+        heapq.heappush(self._schedule, (due, next(self._seq), key, result, schedule))
+        self._cond.notify_all()
+
+    def _run(self):
+        with self._cond:
+            while not self._closed:
+                if len(self._schedule) == 0:
+                    self._cond.wait()
+                    continue
+
+                wait_secs = self._schedule[0][0] - time.perf_counter()
+                if wait_secs > 0:
+                    self._cond.wait(wait_secs)
+                    continue
+
+                _, _, key, result, schedule = heapq.heappop(self._schedule)
+                self._executor.submit(self._poll, key, result, schedule)
+
+    def _poll(self, key, result, schedule):
+        try:
+            result.check_status()
+            if result.is_ready() or not self.wait_ready:
+                self._completions.put((key, result, None))
+                return
+        except Exception as e:
+            self._completions.put((key, result, e))
+            return
+
+        interval = schedule.next_interval(result._progress)
+        with self._cond:
+            if not self._closed:
+                self._push(key, result, schedule, interval)
+
+
+class DownloadStatusTracker(object):
+    """
+    Track status of downloads being prepared on HueDownload in one background thread.
+    The download listing is fetched once per interval, sorted by id descending,
+    and entries are indexed by id to notify every waiter,
+    so the number of listing requests doesn't grow with number of downloads in flight.
+    Further pages are only fetched when a watched id is older than the current page.
+    The thread runs only while there are waiters
+
+    Parameters:
+    fetch_info: callable, takes page, size and sort and returns response of download listing
+    interval: float, default HUE_DOWNLOAD_STATUS_INTERVAL in settings
+        seconds between two listings
+    page_size: int, default HUE_DOWNLOAD_STATUS_PAGE_SIZE in settings
+        number of entries per listing page
+    max_failures: int, default HUE_DOWNLOAD_STATUS_MAX_FAILURES in settings
+        number of consecutive failed listings tolerated, the last error is raised to waiters afterward
+    verbose: bool, default False
+        whether to print log on stdout
+    """
+
+    def __init__(self,
+                 fetch_info,
+                 interval: float = HUE_DOWNLOAD_STATUS_INTERVAL,
+                 page_size: int = HUE_DOWNLOAD_STATUS_PAGE_SIZE,
+                 max_failures: int = HUE_DOWNLOAD_STATUS_MAX_FAILURES,
+                 verbose: bool = False):
+        self.fetch_info = fetch_info
+        self.interval = interval
+        self.page_size = page_size
+        self.max_failures = max_failures
+        self.n_requests = 0
+
+        self.log = logging.getLogger(__name__ + ".DownloadStatusTracker")
+        if verbose:
+            logger.set_stream_log_level(self.log, verbose=verbose)
+
+        self._infos = {}
+        self._errors = {}
+        self._watched = Counter()
+        self._cond = threading.Condition()
+        self._thread = None
+
+    def wait(self, download_id: int, timeout: float = float("inf")):
+        """
+        wait until download is no longer in submit status
+
+        :param download_id: id of download returned by HueDownload
+        :param timeout: seconds to wait, raises TimeoutError when exceeded
+        :return: dict of download info from listing
+        """
+        deadline = time.perf_counter() + timeout
+        with self._cond:
+            self._watched[download_id] += 1
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="hue-download-tracker", daemon=True)
+                self._thread.start()
+
+            try:
+                while True:
+                    info = self._infos.get(download_id)
+                    if info is not None and info["status"] != 0:
+                        return info
+                    if download_id in self._errors:
+                        raise self._errors[download_id]
+
+                    remaining = deadline - time.perf_counter()
+                    if remaining <= 0:
+                        raise TimeoutError(f"download {download_id} is not ready in {timeout} secs")
+                    self._cond.wait(None if remaining == float("inf") else remaining)
+            finally:
+                self._watched[download_id] -= 1
+                if self._watched[download_id] <= 0:
+                    del self._watched[download_id]
+                    self._infos.pop(download_id, None)
+                    self._errors.pop(download_id, None)
+
+    def _run(self):
+        n_failures = 0
+        while True:
+            time.sleep(self.interval)
+            with self._cond:
+                if len(self._watched) == 0:
+                    self._thread = None
+                    return
+                watched = set(self._watched)
+
+            try:
+                infos, missing = self._fetch(watched)
+                errors = {download_id: LookupError(f"cannot get info with download id: {download_id}")
+                          for download_id in missing}
+                n_failures = 0
+            except Exception as e:
+                # a failed listing is retried on next interval until failures pile up
+                n_failures += 1
+                self.log.warning(f"failed to get download info in {n_failures}/{self.max_failures} attempts: {e}")
+                infos, errors = {}, {}
+                if n_failures >= self.max_failures:
+                    errors = {download_id: e for download_id in watched}
+                    n_failures = 0
+
+            with self._cond:
+                self._infos.update({download_id: info for download_id, info in infos.items()
+                                    if download_id in self._watched})
+                for download_id, e in errors.items():
+                    if download_id in self._watched:
+                        self._errors[download_id] = e
+                self._cond.notify_all()
+
+    def _fetch(self, watched: set):
+        infos = {}
+        page = 0
+        while True:
+            res = self.fetch_info(page=page, size=self.page_size, sort="id,desc")
+            self.n_requests += 1
+            content = res.json()["content"]
+            for info in content:
+                if info["id"] in watched:
+                    infos[info["id"]] = info
+
+            missing = watched.difference(infos)
+            # entries are sorted by id descending, ids newer than the oldest entry would have been listed
+            if len(content) == 0 or len(missing) == 0 \
+                    or all(download_id > content[-1]["id"] for download_id in missing):
+                break
+            page += 1
+
+        self.log.debug(f"tracking {len(watched)} downloads, {page + 1} listing pages fetched")
+        return infos, missing
@@ -0,0 +1,164 @@
+import logging
+import queue
+import threading
+
+from .. import logger
+from ..settings import HUE_MAX_CONCURRENT_SQL, HUE_POOL_CHECKOUT_TIMEOUT
+
+__all__ = ["NotebookPool"]
+
+
+class NotebookPool(object):
+    """
+    Bounded pool of Notebook workers that are checked out to execute a sql and returned afterward,
+    so that number of notebooks on both sides scales with concurrency rather than number of sqls.
+    Workers are created lazily up to size and share the session of notebook,
+    those returned as broken get a session of their own when they are checked out the next time.
+    Statement of the last result of a worker is closed once its rows are consumed,
+    or right away when the worker is checked out again if they already are
+
+    Parameters:
+    notebook: Notebook, logged in notebook to derive workers from, it is also the first worker
+    size: int, default HUE_MAX_CONCURRENT_SQL in settings
+        maximum number of workers
+    name: str, default ""
+        prefix of worker notebook names
+    description: str, default ""
+        description of worker notebooks
+    verbose: bool, default False
+        whether to print log on stdout
+    """
+
+    def __init__(self,
+                 notebook,
+                 size: int = HUE_MAX_CONCURRENT_SQL,
+                 name: str = "",
+                 description: str = "",
+                 verbose: bool = False):
+        self.notebook = notebook
+        self.size = size
+        self.name = name
+        self.description = description
+        self.verbose = verbose
+
+        self.log = logging.getLogger(__name__ + ".NotebookPool")
+        if verbose:
+            logger.set_stream_log_level(self.log, verbose=verbose)
+
+        self.workers = [notebook]
+        self._broken = set()
+        # id of worker -> NotebookResult of its last statement that is still open
+        self._results = {}
+        self._idle = queue.LifoQueue()
+        self._idle.put(notebook)
+        self._lock = threading.Lock()
+
+    def checkout(self, timeout: float = HUE_POOL_CHECKOUT_TIMEOUT):
+        """
+        get an idle worker, a new one is created if none is idle and the pool is not full,
+        otherwise wait for a worker to be returned
+
+        :param timeout: seconds to wait, default HUE_POOL_CHECKOUT_TIMEOUT in settings,
+                        raises TimeoutError when exceeded
+        :return: Notebook
+        """
+        try:
+            worker = self._idle.get_nowait()
+        except queue.Empty:
+            with self._lock:
+                worker = self._new_worker() if len(self.workers) < self.size else None
+
+            if worker is None:
+                try:
+                    worker = self._idle.get(timeout=timeout)
+                except queue.Empty:
+                    raise TimeoutError(f"no notebook is returned to pool in {timeout} secs, "
+                                       f"all {self.size} are in use")
+
+        self._release_result(worker)
+        return self._ensure_healthy(worker)
+
+    def checkin(self, worker, result=None, close_statement: bool = False, broken: bool = False):
+        """
+        return a worker to the pool
+
+        :param worker: Notebook checked out from this pool
+        :param result: NotebookResult of the last executed statement of worker,
+                       its statement is closed once its rows are consumed
+        :param close_statement: whether to close the last executed statement of worker on Hue,
+                                leave it False if its result is still to be fetched
+        :param broken: whether the worker failed, so that its session is recreated on next checkout
+        """
+        if hasattr(worker, "snippet"):
+            if close_statement:
+                try:
+                    worker._close_statement()
+                except Exception as e:
+                    self.log.warning(f"failed to close statement of {worker.name}: {e}")
+            # detach the statement so that the next execution won't close it
+            del worker.snippet
+
+        if result is not None and not close_statement:
+            with self._lock:
+                self._results[id(worker)] = result
+
+        if broken:
+            self._broken.add(id(worker))
+
+        self._idle.put(worker)
+
+    def close(self):
+        for worker in self.workers:
+            worker.close()
+
+    def _release_result(self, worker):
+        """
+        close statement of the last result of worker, or as soon as its rows are consumed
+        """
+        with self._lock:
+            result = self._results.pop(id(worker), None)
+
+        if result is not None:
+            try:
+                result.close_when_consumed()
+            except Exception as e:
+                self.log.warning(f"failed to close statement of {worker.name}: {e}")
+
+    def _new_worker(self):
+        name = self.name + f"-worker-{len(self.workers)}"
+        self.log.debug(f"creating {name}")
+        worker = self.notebook.new_notebook(name,
+                                            self.description,
+                                            hive_settings=None,
+                                            recreate_session=False,
+                                            verbose=self.verbose)
+        self.workers.append(worker)
+        return worker
+
+    def _ensure_healthy(self, worker):
+        if id(worker) not in self._broken:
+            return worker
+
+        try:
+            if self._is_session_shared(worker):
+                # workers share the session of the notebook they derive from,
+                # closing it would break statements running on the others
+                self.log.info(f"creating own session of {worker.name}")
+                worker._create_session()
+                worker.notebook["sessions"] = [worker.session]
+            else:
+                self.log.info(f"recreating session of {worker.name}")
+                worker.recreate_session(worker.hive_settings)
+        except Exception as e:
+            self.log.warning(f"failed to recreate session of {worker.name}: {e}")
+            self._idle.put(worker)
+            raise
+
+        self._broken.discard(id(worker))
+        return worker
+
+    def _is_session_shared(self, worker):
+        session_id = getattr(worker, "session", {}).get("id")
+        with self._lock:
+            return any(other is not worker and getattr(other, "session", {}).get("id") == session_id
+                       for other in self.workers)
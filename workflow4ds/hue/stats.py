@@ -0,0 +1,151 @@
+import json
+import logging
+import threading
+
+from .. import logger
+from ..settings import HUE_ROW_COUNT_USE_STATS
+
+__all__ = ["RowCounter"]
+
+# table parameters read from describe formatted
+STATS_PARAMETERS = ("numRows", "totalSize", "COLUMN_STATS_ACCURATE", "transient_lastDdlTime")
+
+
+def parse_table_parameters(rows: list):
+    """
+    pick table parameters out of rows of describe formatted,
+    they are listed as key-value pairs after the "Table Parameters:" row
+    """
+    parameters = {}
+    for row in rows:
+        cells = [str(cell).strip() if cell is not None else "" for cell in row]
+        for i, cell in enumerate(cells[:-1]):
+            if cell in STATS_PARAMETERS:
+                parameters[cell] = cells[i + 1]
+                break
+
+    return parameters
+
+
+def rows_from_stats(parameters: dict):
+    """
+    :return: number of rows from table statistics, None if they are missing or stale,
+             statistics are only trusted when COLUMN_STATS_ACCURATE marks BASIC_STATS true
+    """
+    try:
+        n_rows = int(parameters["numRows"])
+    except (KeyError, ValueError):
+        return None
+
+    if n_rows < 0:
+        return None
+
+    try:
+        accurate = json.loads(parameters["COLUMN_STATS_ACCURATE"])
+        if str(accurate.get("BASIC_STATS", "")).lower() != "true":
+            return None
+    except (KeyError, ValueError, AttributeError):
+        return None
+
+    # stats of a table filled without gathering statistics
+    if n_rows == 0 and parameters.get("totalSize", "0") not in ("", "0"):
+        return None
+
+    return n_rows
+
+
+class RowCounter(object):
+    """
+    Count rows of tables from metastore statistics read by describe formatted,
+    which doesn't launch any job, falls back to select count(*) when statistics are missing or stale.
+    Counts read from accurate statistics are cached per table along with its transient_lastDdlTime,
+    so that stats are read again only after table is modified.
+    Counts of select count(*) are never cached, as e.g. partitions or files of external tables
+    are added without changing transient_lastDdlTime of the table
+
+    Parameters:
+    client: hue, to run describe and count queries
+    use_stats: bool, default HUE_ROW_COUNT_USE_STATS in settings
+        whether to read table statistics, otherwise always count(*)
+    verbose: bool, default False
+        whether to print log on stdout
+    """
+
+    def __init__(self,
+                 client,
+                 use_stats: bool = HUE_ROW_COUNT_USE_STATS,
+                 verbose: bool = False):
+        self.client = client
+        self.use_stats = use_stats
+
+        self.log = logging.getLogger(__name__ + ".RowCounter")
+        if verbose:
+            logger.set_stream_log_level(self.log, verbose=verbose)
+
+        # table -> (transient_lastDdlTime, number of rows)
+        self._cache = {}
+        self._lock = threading.Lock()
+
+    def count(self, tables, progressbar: bool = False, progressbar_offset: int = 0):
+        """
+        :param tables: table name or list of table names
+        :param progressbar: whether to show progressbar of queries
+        :param progressbar_offset: position of tqdm progressbar
+        :return: number of rows, or list of them if tables is a list
+        """
+        lst_tables = [tables] if isinstance(tables, str) else list(tables)
+        lst_rows = [None] * len(lst_tables)
+        # counts to cache along with transient_lastDdlTime
+        lst_cached = []
+
+        if self.use_stats and len(lst_tables):
+            lst_res = self.client.run_sqls([f"describe formatted {table}" for table in lst_tables],
+                                           desc="reading table stats",
+                                           progressbar=progressbar,
+                                           progressbar_offset=progressbar_offset)
+            for i, (table, res) in enumerate(zip(lst_tables, lst_res)):
+                try:
+                    parameters = parse_table_parameters(res.fetchall(progressbar=False)["data"])
+                except Exception as e:
+                    self.log.warning(f"cannot read stats of {table}: {e}")
+                    continue
+
+                ddl_time = parameters.get("transient_lastDdlTime")
+                with self._lock:
+                    cached = self._cache.get(table.lower())
+                if cached is not None and ddl_time is not None and cached[0] == ddl_time:
+                    self.log.debug(f"got {table} size {cached[1]} from cache")
+                    lst_rows[i] = cached[1]
+                    continue
+
+                lst_rows[i] = rows_from_stats(parameters)
+                if lst_rows[i] is not None:
+                    self.log.debug(f"got {table} size {lst_rows[i]} from stats")
+                    if ddl_time is not None:
+                        lst_cached.append((table, ddl_time, lst_rows[i]))
+
+        lst_count = [i for i, n_rows in enumerate(lst_rows) if n_rows is None]
+        if len(lst_count):
+            self.log.info(f"counting rows of {[lst_tables[i] for i in lst_count]}")
+            lst_res = self.client.run_sqls([f"select count(*) from {lst_tables[i]}" for i in lst_count],
+                                           desc="checking table sizes",
+                                           progressbar=progressbar,
+                                           progressbar_offset=progressbar_offset)
+            for i, res in zip(lst_count, lst_res):
+                lst_rows[i] = int(res.fetchall(progressbar=False)["data"][0][0])
+
+        with self._lock:
+            for table, ddl_time, n_rows in lst_cached:
+                self._cache[table.lower()] = (ddl_time, n_rows)
+
+        return lst_rows[0] if isinstance(tables, str) else lst_rows
+
+    def invalidate(self, table: str = None):
+        """
+        forget cached count of a table, or of all tables if table is None
+        """
+        with self._lock:
+            if table is None:
+                self._cache.clear()
+            else:
+                self._cache.pop(table.lower(), None)
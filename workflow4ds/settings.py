@@ -1,4 +1,5 @@
 import sys
+import os
 import importlib.util
 
 HUE_BASE_URL = "http://10.19.166.2:8000"
@@ -10,8 +11,66 @@ MAX_LEN_PRINT_SQL = 100
 HUE_INACTIVE_TIME = 1800
 
 HUE_MAX_CONCURRENT_SQL = 4
+# seconds to wait for a notebook to be returned to hue.pool.NotebookPool before giving up
+HUE_POOL_CHECKOUT_TIMEOUT = 1800
 
 HUE_DOWNLOAD_LARGE_TABLE_ROWS = 100000
+# hash buckets of a large table are sized to this fraction of HUE_DOWNLOAD_LARGE_TABLE_ROWS, as their sizes vary
+HUE_DOWNLOAD_HASH_SPLIT_FILL = .8
+# listing page size and interval of DownloadStatusTracker, one listing serves all downloads in flight
+HUE_DOWNLOAD_STATUS_PAGE_SIZE = 50
+HUE_DOWNLOAD_STATUS_INTERVAL = 5.
+# consecutive failed listings tolerated before waiting downloads fail
+HUE_DOWNLOAD_STATUS_MAX_FAILURES = 3
+# wider tables are downloaded in column shards of this many columns
+HUE_DOWNLOAD_MAX_COLUMNS = 200
+# whether table sizes are read from metastore statistics before falling back to count(*)
+HUE_ROW_COUNT_USE_STATS = True
+
+# number of result pages NotebookResult fetches ahead in background, 0 to disable
+HUE_RESULT_PREFETCH_PAGES = 1
+
+# adaptive rows per fetch_result_data request, see hue.hue.FetchSizeController
+HUE_FETCH_ADAPTIVE = True
+HUE_FETCH_MIN_ROWS = 1024
+HUE_FETCH_MAX_ROWS = 262144
+# rows per request grows until a page reaches either of these targets
+HUE_FETCH_TARGET_BYTES = 16 * 1024 * 1024
+HUE_FETCH_TARGET_SECS = 10.
+HUE_FETCH_TIMEOUT_SECS = 300
+
+# bytes per chunk streamed to file from Hue result export, see hue.hue.NotebookResult.download
+HUE_EXPORT_CHUNK_SIZE = 1024 * 1024
+# rows Hue exports at most, i.e. download_row_limit in hue.ini,
+# larger results are fetched page by page instead
+HUE_EXPORT_MAX_ROWS = 100000
+# rows serialized at a time when a DataFrame or parquet file is uploaded as csv
+HUE_UPLOAD_CHUNK_ROWS = 100000
+
+# lines of query log kept by NotebookResult, and latest lines sent back to Hue on each poll
+HUE_LOG_MAX_LINES = 10000
+HUE_LOG_TAIL_LINES = 50
+
+# status polling interval of a running query, see hue.poller.PollSchedule
+# the interval starts at min and grows by factor up to max while the query progress does not change
+HUE_POLL_MIN_SECS = .2
+HUE_POLL_MAX_SECS = 30.
+HUE_POLL_BACKOFF_FACTOR = 2.
+
+# opt-in on-disk cache of query results in parquet, see hue.cache.ResultCache
+HUE_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".workflow4ds", "hue_cache")
+HUE_CACHE_TTL_SECS = 24 * 3600
+HUE_CACHE_MAX_BYTES = 10 * 1024 ** 3
+
+# size of connection pool shared by hue.aio.AsyncNotebook and notebooks made from it
+HUE_ASYNC_MAX_CONNECTIONS = 100
+
+# maximum distinct values remembered per column while normalizing result cells
+HUE_NORMALIZE_MEMO_SIZE = 65536
+
+# json decoder of result pages, "orjson", "ijson" or "json", None for the fastest installed,
+# ijson parses incrementally from the socket, which is slower but bounds peak memory of a page
+HUE_JSON_BACKEND = None
 
 TEZ_SESSION_TIMEOUT_SECS = 300
 
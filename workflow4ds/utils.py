@@ -1,5 +1,7 @@
 import re
 import os
+import csv
+import io
 import socket
 import numpy as np
 import pandas as pd
@@ -102,6 +104,102 @@ def append_df_to_csv(filename, df: pd.DataFrame, **to_csv_kwargs):
         df.to_csv(filename, mode='a', header=False, **to_csv_kwargs)
 
 
+def count_csv_rows(filename, header=True, block_size=1024 * 1024):
+    """
+    Count rows of csv file [filename] by scanning line breaks in binary,
+    rows are not parsed, so line breaks quoted within a cell are counted as well.
+
+    @param filename: csv path
+    @param header: whether the first line is header
+    @param block_size: bytes read at a time
+    @return: number of rows
+    """
+    n_lines, last = 0, b"\n"
+    with open(filename, "rb") as f:
+        for _, data in read_file_in_chunks(f, block_size):
+            if len(data):
+                n_lines += data.count(b"\n")
+                last = data[-1:]
+
+    # count the last line if it doesn't end with line break
+    n_lines += last != b"\n"
+    return max(n_lines - header, 0)
+
+
+def merge_csv_files(src_paths, dst_path, column_names: list = None, encoding="utf-8"):
+    """
+    Concatenate csv files with the same columns into [dst_path] byte by byte,
+    header line of every file but the first is dropped. Rows are never parsed,
+    file content is copied in kernel where the OS supports it, so memory usage is constant.
+
+    @param src_paths: iterable of csv paths, each starts with a header line
+    @param dst_path: path of merged csv file, overwritten if exists
+    @param column_names: rewrite header of merged file with these names if given
+    @param encoding: encoding of csv files
+    @return: number of bytes written
+    """
+    bom = "\ufeff".encode(encoding) if encoding.lower().replace("-", "").startswith("utf") else b""
+    with open(dst_path, "wb", buffering=0) as dst:
+        for i, src_path in enumerate(src_paths):
+            with open(src_path, "rb") as src:
+                header = src.readline()
+                if i == 0 and column_names:
+                    line_terminator = "\r\n" if header.endswith(b"\r\n") else "\n"
+                    buffer = io.StringIO()
+                    csv.writer(buffer, lineterminator=line_terminator).writerow(column_names)
+                    header = (bom if header.startswith(bom) else b"") + buffer.getvalue().encode(encoding)
+                if i == 0:
+                    dst.write(header)
+
+                offset = src.tell()
+                size = os.fstat(src.fileno()).st_size - offset
+                if size <= 0:
+                    continue
+
+                _copy_file_range(src, dst, offset, size)
+                # the next file continues on a new line
+                src.seek(offset + size - 1)
+                if src.read(1) != b"\n":
+                    dst.write(b"\n")
+
+        return dst.tell()
+
+
+def _copy_file_range(src, dst, offset: int, size: int):
+    """
+    copy [size] bytes of [src] from [offset] to current position of [dst],
+    with copy_file_range or sendfile if available, otherwise through user space
+    """
+    src_fd, dst_fd = src.fileno(), dst.fileno()
+    copied = 0
+    for copy in (getattr(os, "copy_file_range", None), getattr(os, "sendfile", None)):
+        if copy is None:
+            continue
+
+        try:
+            while copied < size:
+                if copy is os.sendfile:
+                    n = os.sendfile(dst_fd, src_fd, offset + copied, size - copied)
+                else:
+                    n = os.copy_file_range(src_fd, dst_fd, size - copied, offset + copied)
+                if n == 0:
+                    break
+                copied += n
+            return
+        except OSError:
+            # e.g. not supported between these file systems, continue where it stopped
+            continue
+
+    src.seek(offset + copied)
+    remaining = size - copied
+    while remaining > 0:
+        chunk = src.read(min(remaining, 1024 * 1024))
+        if not chunk:
+            break
+        dst.write(chunk)
+        remaining -= len(chunk)
+
+
 def append_df_to_excel(filename, df: pd.DataFrame,
                        sheet_name='Sheet1',
                        startrow=None,